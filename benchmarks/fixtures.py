@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark fixtures: a synthetic photo tree generator (sizes, formats and exif orientations mix),
+reproducible from a seed. The sqlite stand-in of the lychee db is shared with the tests (see tests.fixtures)
+"""
+
+import os
+import random
+import struct
+from PIL import Image
+
+# (format, extension, share of the photos)
+FORMATS = [("JPEG", ".jpg", 0.7), ("PNG", ".png", 0.2), ("GIF", ".gif", 0.1)]
+# long edge of the photos, in pixels
+SIZES = [640, 1024, 2048, 3264, 4000]
+
+
+def orientationExif(orientation):
+    """
+    Returns a minimal exif segment holding only an orientation tag
+    """
+    tiff = "MM\x00*" + struct.pack(">L", 8)
+    tiff += struct.pack(">H", 1) + struct.pack(">HHLHH", 0x0112, 3, 1, orientation, 0) + struct.pack(">L", 0)
+    return "Exif\x00\x00" + tiff
+
+
+def syntheticImage(size, rnd):
+    """
+    Returns an RGB image with smooth and sharp areas, so that it compresses like a photo
+    """
+    gradient = Image.linear_gradient('L').rotate(rnd.randint(0, 359)).resize(size)
+    radial = Image.radial_gradient('L').resize(size)
+    noise = Image.effect_noise((max(size[0] / 8, 1), max(size[1] / 8, 1)), 64).resize(size)
+    return Image.merge('RGB', (gradient, radial, noise))
+
+
+def generateTree(root, count, seed=0, albums=5):
+    """
+    Generate a source directory of synthetic photos
+    Parameters:
+    - root: the directory to fill, albums are created in it
+    - count: the number of photos
+    - seed: the random seed, the same seed gives the same tree
+    - albums: the number of albums (sub directories)
+    Returns the list of generated photo full paths
+    """
+    rnd = random.Random(seed)
+    paths = []
+    for i in range(count):
+        album = os.path.join(root, "album%02d" % (i % albums))
+        if not os.path.exists(album):
+            os.makedirs(album)
+        pick = rnd.random()
+        for fmt, ext, share in FORMATS:
+            pick -= share
+            if pick <= 0:
+                break
+        edge = rnd.choice(SIZES)
+        size = (edge, edge * 3 / 4) if rnd.random() < 0.7 else (edge * 3 / 4, edge)
+        img = syntheticImage(size, rnd)
+        path = os.path.join(album, "photo%05d%s" % (i, ext))
+        if fmt == "JPEG":
+            img.save(path, fmt, quality=90, exif=orientationExif(rnd.randint(1, 8)))
+        elif fmt == "GIF":
+            img.convert('P').save(path, fmt)
+        else:
+            img.save(path, fmt)
+        paths.append(path)
+    return paths
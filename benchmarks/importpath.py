@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the import hot path, stage by stage, on a synthetic photo tree
+(see benchmarks.fixtures) and a sqlite stand-in of the lychee db:
+- photo: LycheePhoto construction and header / exif reading
+- adjustRotation: rotation of the decoded photo
+- makeThumbnail: decode, rotation and thumbnails
+- addFileToAlbum: file placement and db insert (batched, the final flush is counted)
+
+Each stage reports photos/s, MB/s (of source files), p50/p99 latency and the process peak RSS after it.
+Results are appended to a json lines file and compared with the previous run of the same parameters.
+
+usage: python -m benchmarks.importpath [-n photos] [--seed seed] [--results file]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from PIL import Image
+from lycheedao import LycheeDAO
+from lycheemodel import LycheePhoto
+from lycheesyncer import LycheeSyncer
+from benchmarks.fixtures import generateTree
+from tests.fixtures import SqlitePool
+
+STAGES = ["photo", "adjustRotation", "makeThumbnail", "addFileToAlbum"]
+# a stage slower than this, compared with the previous run, is reported as a regression
+REGRESSION = 0.10
+
+
+def percentile(values, p):
+    """
+    Returns the p percentile (0-100) of a list of values
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round((len(values) - 1) * p / 100.0))
+    return values[index]
+
+
+def peakRss():
+    """
+    Returns the peak resident memory of this process, in MB
+    """
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def stageStats(timings, sizes, extra=0.0):
+    """
+    Parameters:
+    - timings: the per photo durations, in seconds
+    - sizes: the source file sizes, in bytes
+    - extra: time spent for the whole stage and not for a photo (batched db writes)
+    Returns the stats dictionnary of a stage
+    """
+    total = sum(timings) + extra
+    return {
+        "photos": len(timings),
+        "seconds": total,
+        "photos_s": len(timings) / total if total else 0.0,
+        "mb_s": sum(sizes) / 1048576.0 / total if total else 0.0,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "peak_rss_mb": peakRss(),
+    }
+
+
+def album(path):
+    return {'path': os.path.dirname(path), 'name': os.path.basename(os.path.dirname(path)), 'id': None}
+
+
+def runStages(conf, paths):
+    """
+    Run every stage on every photo
+    Returns a dictionnary key=stage name value=stats
+    """
+    syncer = LycheeSyncer(conf)
+    syncer.dao = LycheeDAO(conf, SqlitePool(conf, conf["benchdb"]))
+    sizes = [os.path.getsize(path) for path in paths]
+    results = {}
+
+    timings = []
+    for path in paths:
+        start = time.time()
+        photo = LycheePhoto(conf, os.path.basename(path), album(path))
+        photo.exif
+        timings.append(time.time() - start)
+    results["photo"] = stageStats(timings, sizes)
+
+    timings = []
+    for path in paths:
+        photo = LycheePhoto(conf, os.path.basename(path), album(path))
+        img = Image.open(path)
+        img.load()
+        start = time.time()
+        syncer.adjustRotation(photo, img)
+        timings.append(time.time() - start)
+    results["adjustRotation"] = stageStats(timings, sizes)
+
+    photos = []
+    timings = []
+    for path in paths:
+        photo = LycheePhoto(conf, os.path.basename(path), album(path))
+        photo.exif
+        start = time.time()
+        syncer.makeThumbnail(photo)
+        timings.append(time.time() - start)
+        photos.append(photo)
+    results["makeThumbnail"] = stageStats(timings, sizes)
+
+    timings = []
+    for photo in photos:
+        photo.albumid = syncer.createAlbum(photo.albumname)
+        start = time.time()
+        syncer.addFileToAlbum(photo)
+        timings.append(time.time() - start)
+    start = time.time()
+    syncer.dao.close()
+    results["addFileToAlbum"] = stageStats(timings, sizes, time.time() - start)
+    return results
+
+
+def gitRevision():
+    """
+    Returns the current git commit of lycheesync, or None
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previousRun(resultsfile, params):
+    """
+    Returns the last stored run with the same parameters, or None
+    """
+    if not os.path.exists(resultsfile):
+        return None
+    previous = None
+    with open(resultsfile) as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if run.get("params") == params:
+                previous = run
+    return previous
+
+
+def report(run, previous):
+    """
+    Print the stats of a run, compared with a previous one
+    Returns the list of regressed stages
+    """
+    regressions = []
+    print "%-16s %10s %10s %10s %10s %10s %10s" % ("stage", "photos/s", "MB/s", "p50 ms", "p99 ms", "rss MB", "vs prev")
+    for stage in STAGES:
+        stats = run["stages"][stage]
+        delta = ""
+        if previous is not None and stage in previous["stages"] and previous["stages"][stage]["photos_s"]:
+            change = stats["photos_s"] / previous["stages"][stage]["photos_s"] - 1
+            delta = "%+.1f%%" % (change * 100)
+            if change < -REGRESSION:
+                delta += " !"
+                regressions.append(stage)
+        print "%-16s %10.1f %10.2f %10.2f %10.2f %10.1f %10s" % (stage, stats["photos_s"], stats["mb_s"],
+                                                                stats["p50_ms"], stats["p99_ms"],
+                                                                stats["peak_rss_mb"], delta)
+    if previous is not None:
+        print "compared with run of", previous["date"], "(" + str(previous["revision"]) + ")"
+    if regressions:
+        print "REGRESSION in:", ", ".join(regressions)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the import hot path on a synthetic photo tree")
+    parser.add_argument('-n', '--photos', type=int, default=100, help='number of synthetic photos')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic tree')
+    parser.add_argument('--thumb-mode', dest='thumbmode', default='quality', help='thumbMode to benchmark')
+    parser.add_argument('--placement', default='copy', help='placement to benchmark')
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(__file__), 'results.jsonl'),
+                        help='json lines file runs are stored in')
+    args = parser.parse_args()
+
+    params = {"photos": args.photos, "seed": args.seed, "thumbMode": args.thumbmode, "placement": args.placement}
+    workdir = tempfile.mkdtemp(prefix='lycheesync-bench-')
+    try:
+        srcdir = os.path.join(workdir, 'src')
+        lycheepath = os.path.join(workdir, 'lychee')
+        for d in ('big', 'thumb'):
+            os.makedirs(os.path.join(lycheepath, 'uploads', d))
+        print "generating", args.photos, "photos..."
+        paths = generateTree(srcdir, args.photos, args.seed)
+        conf = {'lycheepath': lycheepath, 'srcdir': srcdir, 'thumbMode': args.thumbmode, 'thumbQuality': 80,
+                'placement': args.placement, 'link': False, 'uid': os.getuid(), 'gid': os.getgid(),
+                'verbose': False, 'dropdb': False, 'publicAlbum': 0,
+                'dbHost': '', 'dbUser': '', 'dbPassword': '', 'db': '',
+                'benchdb': os.path.join(workdir, 'lychee.db')}
+        run = {"date": datetime.datetime.now().isoformat(), "revision": gitRevision(), "params": params,
+               "stages": runStages(conf, paths)}
+    finally:
+        shutil.rmtree(workdir)
+
+    report(run, previousRun(args.results, params))
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(run, sort_keys=True) + "\n")
+
+
+if __name__ == '__main__':
+    main()
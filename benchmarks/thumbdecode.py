@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the two thumbMode of LycheeSyncer.makeThumbnail
+- quality: full decode of the photo
+- fast: jpeg draft mode decode
+
+usage: python -m benchmarks.thumbdecode [-n runs] photo1.jpg photo2.jpg ...
+"""
+
+import argparse
+import math
+import os
+import shutil
+import tempfile
+import time
+from PIL import Image, ImageChops, ImageStat
+from lycheesyncer import LycheeSyncer
+from lycheemodel import LycheePhoto
+
+
+def decodedSize(photo, mode):
+    """
+    Returns the size of the image really decoded for a given thumbMode
+    """
+    img = Image.open(photo.srcfullpath)
+    if mode == 'fast' and photo.exif.orientation not in LycheeSyncer.orientations:
+        img.draft(img.mode, (400, 400))
+    img.load()
+    return img.size
+
+
+def psnr(path1, path2):
+    """
+    Peak signal to noise ratio between two images of the same size, in dB
+    Returns None if images are identical
+    """
+    img1 = Image.open(path1).convert('RGB')
+    img2 = Image.open(path2).convert('RGB')
+    diff = ImageChops.difference(img1, img2)
+    mse = sum(ImageStat.Stat(diff).sum2) / float(img1.size[0] * img1.size[1] * 3)
+    if mse == 0:
+        return None
+    return 10 * math.log10(255 * 255 / mse)
+
+
+def render(conf, path, runs):
+    """
+    Renders thumbnails of a photo runs times
+    Returns the best time and the last rendered LycheePhoto
+    """
+    syncer = LycheeSyncer(conf)
+    best = None
+    photo = None
+    for i in range(runs):
+        photo = LycheePhoto(conf, os.path.basename(path), {'path': os.path.dirname(path), 'id': 0, 'name': ''})
+        start = time.time()
+        syncer.makeThumbnail(photo)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, photo
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark quality and fast thumbMode")
+    parser.add_argument('photos', nargs='+', help='jpeg photos to thumbnail')
+    parser.add_argument('-n', '--runs', type=int, default=3, help='runs per photo, best time is kept')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='lycheesync-bench-')
+    try:
+        totals = {'quality': 0.0, 'fast': 0.0}
+        print "%-30s %12s %12s %12s %12s %8s" % ("photo", "decoded q", "decoded f", "quality (s)", "fast (s)", "PSNR")
+        for path in args.photos:
+            thumbs = {}
+            timings = {}
+            for mode in ('quality', 'fast'):
+                lycheepath = os.path.join(workdir, mode)
+                for d in ('big', 'thumb'):
+                    if not os.path.exists(os.path.join(lycheepath, 'uploads', d)):
+                        os.makedirs(os.path.join(lycheepath, 'uploads', d))
+                conf = {'lycheepath': lycheepath, 'thumbMode': mode, 'thumbQuality': 99}
+                timings[mode], photo = render(conf, path, args.runs)
+                thumbs[mode] = photo.thumbnailx2fullpath
+                totals[mode] += timings[mode]
+
+            q = decodedSize(photo, 'quality')
+            f = decodedSize(photo, 'fast')
+            fidelity = psnr(thumbs['quality'], thumbs['fast'])
+            print "%-30s %12s %12s %12.4f %12.4f %8s" % (os.path.basename(path)[-30:],
+                                                         "%dx%d" % q, "%dx%d" % f,
+                                                         timings['quality'], timings['fast'],
+                                                         "inf" if fidelity is None else "%.1f" % fidelity)
+
+        if totals['fast'] > 0:
+            print "speedup: x%.1f" % (totals['quality'] / totals['fast'])
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
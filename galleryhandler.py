@@ -1,55 +1,262 @@
-from watchdog.events import FileSystemEventHandler, FileCreatedEvent, FileDeletedEvent
-from lycheemodel import LycheePhoto
+from watchdog.events import FileSystemEventHandler
 import os
+import threading
+import time
+import traceback
 
 def dict_to_obj(d):
     foo = lambda:0
     foo.__dict__ = d
     return foo
 
+
+class EventQueue:
+
+    """
+    Debounce and coalesce watchdog events per path before they reach the GalleryHandler
+    Every path has at most one pending net action: created, modified, deleted or moved.
+    Event chains are collapsed (created then modified is created, created then deleted is nothing,
+    moved twice is moved once...). An action is dispatched once no event came for the path
+    during conf "eventDelay" seconds (default 2), and, for created and modified files,
+    once their size and mtime did not change during that delay (upload in progress)
+    """
+
+    def __init__(self, handler, delay):
+        """
+        Parameters:
+        - handler: the GalleryHandler the net actions are dispatched to
+        - delay: the settle delay, in seconds
+        """
+        self.handler = handler
+        self.delay = delay
+        # path -> {'action', 'time', 'isdir', 'src', 'stat'}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="lychee-events")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop dispatching, pending deletions and moves are dispatched right away,
+        creations are left to the startup scan of the next run
+        """
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            actions = [(path, entry) for path, entry in self.pending.items()
+                       if entry['action'] in ('deleted', 'moved')]
+            self.pending.clear()
+        for path, entry in actions:
+            self.dispatch(path, entry)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def backlogAge(self):
+        """
+        Returns how long the oldest pending action waits, in seconds
+        """
+        with self.lock:
+            times = [entry['time'] for entry in self.pending.values()]
+        return time.time() - min(times) if times else 0.0
+
+    def statFile(self, path):
+        """
+        Returns the (size, mtime) of a file or None if it does not exist
+        """
+        try:
+            st = os.stat(path)
+            return (st.st_size, st.st_mtime)
+        except OSError:
+            return None
+
+    def push(self, action, path, isdir=False):
+        """
+        Merge a created, modified or deleted event with the pending action of its path
+        """
+        with self.lock:
+            self.merge(action, path, isdir)
+
+    def merge(self, action, path, isdir=False):
+        prev = self.pending.get(path)
+        new = action
+        if prev is not None:
+            old = prev['action']
+            if old == 'created':
+                new = None if action == 'deleted' else 'created'
+            elif old == 'modified':
+                new = 'deleted' if action == 'deleted' else 'modified'
+            elif old == 'deleted':
+                new = 'deleted' if action == 'deleted' else 'modified'
+            elif old == 'moved':
+                # the moved file content changed or it is gone: forget the move
+                del self.pending[path]
+                self.merge('deleted', prev['src'], prev['isdir'])
+                new = None if action == 'deleted' else 'created'
+
+        if new is None:
+            self.pending.pop(path, None)
+            return
+        if new == 'deleted' and isdir:
+            # the directory deletion covers the pending actions of its content (see LycheeSyncer.deleteAlbum)
+            prefix = os.path.join(path, '')
+            for child in [p for p in self.pending if p.startswith(prefix)]:
+                entry = self.pending.pop(child)
+                if entry['action'] == 'moved' and not entry['src'].startswith(prefix):
+                    self.merge('deleted', entry['src'], entry['isdir'])
+        entry = {'action': new, 'time': time.time(), 'isdir': isdir, 'src': None, 'stat': None}
+        if new in ('created', 'modified'):
+            entry['stat'] = self.statFile(path)
+        self.pending[path] = entry
+
+    def pushMove(self, src, dest, isdir=False):
+        """
+        Merge a moved event with the pending actions of its source and destination
+        """
+        with self.lock:
+            prev = self.pending.pop(src, None)
+            if prev is None or (isdir and prev['action'] != 'moved'):
+                entry = {'action': 'moved', 'time': time.time(), 'isdir': isdir, 'src': src, 'stat': None}
+                self.pending[dest] = entry
+            elif prev['action'] == 'created':
+                self.merge('created', dest)
+            elif prev['action'] == 'moved':
+                if prev['src'] == dest:
+                    # moved back
+                    self.pending.pop(dest, None)
+                else:
+                    prev['time'] = time.time()
+                    self.pending[dest] = prev
+            else:
+                # modified or deleted then moved: old version removed, new one imported
+                self.merge('deleted', src)
+                self.merge('created', dest)
+
+    def run(self):
+        while not self.stopped.wait(min(self.delay / 4.0, 0.5)):
+            try:
+                self.dispatchDue()
+            except Exception:
+                print "EventQueue", Exception
+                traceback.print_exc()
+
+    def dispatchDue(self):
+        """
+        Dispatch every settled action
+        """
+        now = time.time()
+        due = []
+        with self.lock:
+            for path, entry in self.pending.items():
+                if now - entry['time'] < self.delay:
+                    continue
+                if entry['action'] in ('created', 'modified'):
+                    st = self.statFile(path)
+                    if st is None:
+                        # gone, its deleted event will follow
+                        del self.pending[path]
+                        continue
+                    if st != entry['stat']:
+                        # still being written
+                        entry['stat'] = st
+                        entry['time'] = now
+                        continue
+                del self.pending[path]
+                due.append((entry['time'], path, entry))
+        for t, path, entry in sorted(due):
+            self.dispatch(path, entry)
+
+    def dispatch(self, path, entry):
+        try:
+            if entry['action'] in ('created', 'modified'):
+                self.handler.importFile(path)
+            elif entry['action'] == 'deleted':
+                if entry['isdir']:
+                    self.handler.deleteDirectory(path)
+                else:
+                    self.handler.deleteFile(path)
+            elif entry['action'] == 'moved':
+                if entry['isdir']:
+                    self.handler.moveDirectory(entry['src'], path)
+                else:
+                    self.handler.moveFile(entry['src'], path)
+        except Exception:
+            print "dispatch", entry['action'], path
+            traceback.print_exc()
+
+
 class GalleryHandler(FileSystemEventHandler):
 
     def __init__(self, syncer):
         super(GalleryHandler, self)
         self.syncer = syncer
-    
+        self.events = EventQueue(self, syncer.conf.get("eventDelay", 2))
+
     def on_created(self, event):
         super(GalleryHandler, self).on_created(event)
-        if self.syncer.isAPhoto(event.src_path):
-            album = {}
-            album['path'] = os.path.dirname(event.src_path)
-            album['relpath'] = os.path.relpath(album['path'], self.syncer.conf['srcdir'])
-            if album['relpath'] == '.':
-                return
-            album['name'] = self.syncer.getAlbumNameFromPath(album['relpath'])
-            album['id'] = self.syncer.createAlbum(album['name'])
-            photo = LycheePhoto(self.syncer.conf, os.path.basename(event.src_path), album)
-            self.syncer.makeThumbnail(photo)
-            self.syncer.addFileToAlbum(photo)
-            self.syncer.adjustRotation(photo)
+        if not event.is_directory:
+            self.events.push('created', event.src_path)
 
     def on_deleted(self, event):
         super(GalleryHandler, self).on_deleted(event)
-        if self.syncer.isAPhoto(event.src_path):
-            album = {}
-            album['path'] = os.path.dirname(event.src_path)
-            album['relpath'] = os.path.relpath(album['path'], self.syncer.conf['srcdir'])
-            album['name'] = self.syncer.getAlbumNameFromPath(album['relpath'])
-            album['id'] = self.syncer.createAlbum(album['name'])
-            self.syncer.dao.erasePhoto(os.path.basename(event.src_path), album['id'])
-        else:
-            album = {}
-            album['path'] = event.src_path
-            album['relpath'] = os.path.relpath(album['path'], self.syncer.conf['srcdir'])
-            album['name'] = self.syncer.getAlbumNameFromPath(album['relpath'])
-            album['id'] = self.syncer.createAlbum(album['name'])
-            self.syncer.dao.eraseAlbum(album)
-            
+        # watchdog can't tell if a deleted path was a directory
+        isdir = event.is_directory or not self.syncer.isAPhoto(event.src_path)
+        self.events.push('deleted', event.src_path, isdir)
 
     def on_modified(self, event):
         super(GalleryHandler, self).on_modified(event)
+        if not event.is_directory:
+            self.events.push('modified', event.src_path)
 
     def on_moved(self, event):
         super(GalleryHandler, self).on_moved(event)
-        self.on_deleted(FileDeletedEvent(event.src_path))
-        self.on_created(FileCreatedEvent(event.dest_path))
+        self.events.pushMove(event.src_path, event.dest_path, event.is_directory)
+
+    def importFile(self, path):
+        """
+        Import a new or modified photo
+        """
+        if self.syncer.isAPhoto(path) and not self.syncer.isSynced(path):
+            album = self.syncer.getAlbumFromPath(os.path.dirname(path))
+            if album['relpath'] == '.':
+                return
+            self.syncer.importer.importPhoto(path, album)
+
+    def deleteFile(self, path):
+        """
+        Remove a deleted photo from lychee
+        """
+        if self.syncer.isAPhoto(path):
+            album = self.syncer.getAlbumFromPath(os.path.dirname(path))
+            self.syncer.importer.write(self.syncer.deletePhoto, album, os.path.basename(path))
+
+    def deleteDirectory(self, path):
+        """
+        Remove the album of a deleted directory from lychee
+        """
+        album = self.syncer.getAlbumFromPath(path)
+        self.syncer.importer.write(self.syncer.deleteAlbum, album)
+
+    def moveFile(self, src, dest):
+        """
+        A photo was moved or renamed: only its db row is updated,
+        uploaded files and thumbnails are kept
+        """
+        srcalbum = self.syncer.getAlbumFromPath(os.path.dirname(src))
+        destalbum = self.syncer.getAlbumFromPath(os.path.dirname(dest))
+        if not self.syncer.isAPhoto(dest) or destalbum['relpath'] == '.':
+            self.deleteFile(src)
+        elif not self.syncer.isAPhoto(src) or srcalbum['relpath'] == '.':
+            self.importFile(dest)
+        else:
+            self.syncer.importer.write(self.syncer.movePhoto, src, dest)
+
+    def moveDirectory(self, src, dest):
+        """
+        A directory was moved or renamed: its albums are renamed
+        """
+        self.syncer.importer.write(self.syncer.moveAlbums, src, dest)
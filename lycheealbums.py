@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+class AlbumResolver:
+
+    """
+    Resolve source directories to lychee album ids, without a db round trip per event:
+    ids are cached by directory relative path, on top of the album titles list of the dao
+    (preloaded from db by LycheeDAO.loadAlbumList and kept up to date on renames, merges and erasures).
+    Only albums missing from lychee are created in db (see LycheeDAO.createAlbum)
+    """
+
+    def __init__(self, syncer):
+        """
+        Takes the LycheeSyncer as input, its dao is used
+        """
+        self.syncer = syncer
+        # relative path -> (album title, album id)
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, relpath, create=True):
+        """
+        Parameters:
+        - relpath: a directory path, relative to the source directory
+        - create: create the album if it does not exist
+        Returns the album id or None if it does not exist (and is not created)
+        """
+        dao = self.syncer.dao
+        with self.lock:
+            cached = self.paths.get(relpath)
+            # a cached id is still good unless its album was renamed, merged or erased since
+            if cached is not None and dao.albumslist.get(cached[0]) == cached[1]:
+                return cached[1]
+            title = self.syncer.getAlbumNameFromPath(relpath)
+            albumid = dao.albumExists(title)
+            if albumid is None and create and title != "":
+                albumid = dao.createAlbum({'name': title})
+            if albumid is None:
+                self.paths.pop(relpath, None)
+            else:
+                self.paths[relpath] = (title, albumid)
+            return albumid
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import traceback
+from lycheeutils import walkTree
+
+
+class LycheeCatalog:
+
+    """
+    Local record of the photos already synced to lychee
+    Maps a source file path (plus its size, mtime and inode) to the
+    lychee photo id, url and checksum, so that unchanged files can be skipped
+    without hashing them nor querying the lychee db.
+    It is stored in a sqlite file (conf "catalog"), shared by the
+    watchdog thread and the db writer thread.
+    """
+
+    columns = ("path", "size", "mtime", "inode", "photoid", "url", "checksum", "albumid")
+
+    def __init__(self, conf):
+        """
+        Takes a dictionnary of conf as input
+        """
+        self.conf = conf
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.conf["catalog"], check_same_thread=False)
+        # paths are byte strings, like the ones watchdog gives us
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("create table if not exists photos (" +
+                        "path text primary key, dir text, size integer, mtime real, inode integer, " +
+                        "photoid text, url text, checksum text, albumid integer)")
+        self.db.execute("create index if not exists photos_dir on photos (dir)")
+        self.db.commit()
+
+    def lookup(self, path):
+        """
+        Parameters:
+        - path: a source photo full path
+        Returns the catalog entry of a photo as a dictionnary, or None
+        """
+        with self.lock:
+            row = self.db.execute("select " + ", ".join(self.columns) +
+                                  " from photos where path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.columns, row))
+
+    def listDirectory(self, dirpath):
+        """
+        Parameters:
+        - dirpath: a source directory full path
+        Returns the catalog entries of the photos directly in this directory, as a dictionnary
+        key=file name value=entry
+        """
+        with self.lock:
+            rows = self.db.execute("select " + ", ".join(self.columns) +
+                                   " from photos where dir = ?", (dirpath,)).fetchall()
+        return dict((os.path.basename(row[0]), dict(zip(self.columns, row))) for row in rows)
+
+    def listDirectories(self):
+        """
+        Returns the set of source directories containing synced photos
+        """
+        with self.lock:
+            rows = self.db.execute("select distinct dir from photos").fetchall()
+        return set(row[0] for row in rows)
+
+    def isUpToDate(self, entry, st=None):
+        """
+        Check a catalog entry against its source file
+        Parameters:
+        - entry: a catalog entry (see lookup)
+        - st: the os.stat result of the file, it is read if not given
+        Returns False if the file changed since it was synced
+        """
+        try:
+            if st is None:
+                st = os.stat(entry["path"])
+        except OSError:
+            return False
+        return (entry["size"] == st.st_size and entry["mtime"] == st.st_mtime and
+                entry["inode"] == st.st_ino)
+
+    def isSynced(self, path):
+        """
+        Parameters:
+        - path: a source photo full path
+        Returns True if the photo is in lychee and did not change since
+        """
+        entry = self.lookup(path)
+        return entry is not None and self.isUpToDate(entry)
+
+    def record(self, photos):
+        """
+        Record photos just added to lychee
+        Parameters:
+        - photos: a list of valid LycheePhoto objects, already in db
+        Returns nothing
+        """
+        self.recordMany([(photo.srcfullpath, photo.filesize, photo.mtime, photo.inode,
+                          photo.id, photo.url, photo.checksum, photo.albumid) for photo in photos])
+
+    def recordMany(self, entries):
+        """
+        Record photos already in lychee, in a single transaction
+        Parameters:
+        - entries: a list of (path, size, mtime, inode, photoid, url, checksum, albumid) tuples
+        Returns nothing
+        """
+        rows = [(entry[0], os.path.dirname(entry[0])) + tuple(entry[1:]) for entry in entries]
+        with self.lock:
+            self.db.executemany("insert or replace into photos values (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+
+    def forget(self, path, commit=True):
+        """
+        Remove a photo from the catalog
+        Set commit to False to group several removals in a transaction, then call commit
+        Parameters:
+        - path: a source photo full path
+        Returns nothing
+        """
+        with self.lock:
+            self.db.execute("delete from photos where path = ?", (path,))
+            if commit:
+                self.db.commit()
+
+    def commit(self):
+        """
+        Commit the current transaction, see the commit parameter of forget
+        Returns nothing
+        """
+        with self.lock:
+            self.db.commit()
+
+    def move(self, src, dest, albumid):
+        """
+        Record a photo move
+        Parameters:
+        - src: the photo previous full path
+        - dest: the photo new full path
+        - albumid: its new album id
+        Returns nothing
+        """
+        with self.lock:
+            self.db.execute("update photos set path = ?, dir = ?, albumid = ? where path = ?",
+                            (dest, os.path.dirname(dest), albumid, src))
+            self.db.commit()
+
+    def moveDirectory(self, src, dest, albumid):
+        """
+        Record the move of the photos directly in a directory
+        Parameters:
+        - src: the directory previous full path
+        - dest: the directory new full path
+        - albumid: the new album id of its photos
+        Returns nothing
+        """
+        with self.lock:
+            # the path prefix is swapped here: sqlite substr counts characters, not bytes
+            rows = self.db.execute("select path from photos where dir = ?", (src,)).fetchall()
+            self.db.executemany("update photos set path = ?, dir = ?, albumid = ? where path = ?",
+                                [(dest + path[len(src):], dest, albumid, path) for (path,) in rows])
+            self.db.commit()
+
+    def forgetTree(self, dirpath):
+        """
+        Remove every photo under a directory from the catalog
+        Parameters:
+        - dirpath: a source directory full path
+        Returns nothing
+        """
+        prefix = os.path.join(dirpath, '')
+        with self.lock:
+            # the prefix length is measured by sqlite, which counts characters, not bytes
+            self.db.execute("delete from photos where substr(path, 1, length(?)) = ?", (prefix, prefix))
+            self.db.commit()
+
+    def clear(self):
+        """
+        Forget every photo, when lychee db is dropped
+        Returns nothing
+        """
+        with self.lock:
+            self.db.execute("delete from photos")
+            self.db.commit()
+
+    def rebuild(self, syncer):
+        """
+        Rebuild the catalog from the lychee db: every photo of the source
+        directory found in db (same album and title) is recorded with its current stat
+        Parameters:
+        - syncer: a LycheeSyncer with an opened dao
+        Returns the number of photos recorded
+        """
+        photos = {}
+        for row in syncer.dao.listPhotos():
+            albumid, title, photoid, url, checksum = row
+            photos[(albumid, title)] = (photoid, url, checksum)
+
+        entries = []
+        for root, files in walkTree(self.conf["srcdir"]):
+            relpath = os.path.relpath(root, self.conf["srcdir"])
+            if relpath == '.':
+                continue
+            albumname = syncer.getAlbumNameFromPath(relpath)
+            albumid = syncer.dao.albumslist.get(albumname)
+            if albumid is None:
+                continue
+            for f in files:
+                if (albumid, f.name) not in photos or not syncer.isAPhoto(f.name):
+                    continue
+                try:
+                    st = f.stat()
+                except OSError:
+                    traceback.print_exc()
+                    continue
+                photoid, url, checksum = photos[(albumid, f.name)]
+                entries.append((f.path, st.st_size, st.st_mtime, st.st_ino, photoid, url, checksum, albumid))
+
+        self.clear()
+        self.recordMany(entries)
+        if self.conf["verbose"]:
+            print "INFO catalog rebuilt:", len(entries), "photos"
+        return len(entries)
+
+    def close(self):
+        """
+        Close the catalog, pending removals are committed
+        Returns nothing
+        """
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -1,9 +1,165 @@
 # -*- coding: utf-8 -*-
 
 import MySQLdb
+import Queue
 import datetime
+import hashlib
+import threading
+import time
 import traceback
-from dateutil.parser import parse
+from contextlib import contextmanager
+from lycheemetrics import metrics
+from lycheemodel import LycheePhoto
+
+
+# Every statement used by LycheeDAO: values are always passed as parameters,
+# never pasted in the statement, so the same statement text is reused across calls
+# and titles containing quotes are safe
+QUERIES = {
+    "minMaxAlbumIds": "select min(id), max(id) from lychee_albums",
+    "updateAlbumDate": "update lychee_albums set sysstamp = %s where id = %s",
+    "movePhotosToAlbum": "update lychee_photos set album = %s where album = %s",
+    "changeAlbumId": "update lychee_albums set id = %s where id = %s",
+    "listAlbums": "select title, id from lychee_albums order by id",
+    "listPhotos": "select id, album, title, url, checksum from lychee_photos",
+    "listPhotoUrls": "select url from lychee_photos",
+    # nothing is inserted if another process (lychee, another lycheesync) created the album meanwhile
+    "createAlbum": ("insert into lychee_albums (title, sysstamp, public, password) " +
+                    "select %s, %s, %s, NULL from dual where not exists (select 1 from lychee_albums where title = %s)"),
+    "albumIdByTitle": "select id from lychee_albums where title = %s order by id limit 1",
+    # mysql named locks, held by the connection: they serialize album creations between processes
+    "lockAlbum": "select GET_LOCK(%s, 10)",
+    "unlockAlbum": "select RELEASE_LOCK(%s)",
+    "addPhoto": ("insert into lychee_photos (" + ", ".join(LycheePhoto.columns) + ") " +
+                 "values (" + ", ".join(["%s"] * len(LycheePhoto.columns)) + ")"),
+    "movePhoto": "update lychee_photos set album = %s, title = %s, star = %s where id = %s",
+    "renameAlbum": "update lychee_albums set title = %s where id = %s",
+    "eraseAlbum": "delete from lychee_albums where id = %s",
+    # {ids} is replaced by as many placeholders as there are parameters (see run)
+    "erasePhotos": "delete from lychee_photos where id in ({ids})",
+    "eraseAlbums": "delete from lychee_albums where id in ({ids})",
+    "dropAlbums": "delete from lychee_albums",
+    "dropPhotos": "delete from lychee_photos",
+}
+
+
+# max number of ids in a single "in (...)" statement
+IN_CHUNK = 1000
+
+# mysql client errors meaning the connection is dead: server has gone away, lost connection
+CONNECTION_LOST = (2006, 2013, 2055)
+
+
+def albumKey(albumid):
+    """
+    lychee_photos.album is a string column while album ids are numbers:
+    the in memory index keys photos by the album id as a long
+    Returns the album id as a long, or None
+    """
+    if albumid is None:
+        return None
+    return long(albumid)
+
+
+class ConnectionPool:
+
+    """
+    A pool of MySQL connections, of one connection by default: lychee db is written
+    by a single thread (see LycheeImporter), so each LycheeDAO holds a single connection.
+    Idle connections are checked with a ping before being handed out
+    and transparently reopened if the server closed them (wait_timeout)
+    """
+
+    def __init__(self, conf, size=None):
+        """
+        Takes a dictionnary of conf as input
+        and the number of connections, for a pool shared by several LycheeDAO
+        """
+        self.conf = conf
+        self.size = size or 1
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.size)
+        # album creations of the LycheeDAO sharing this pool are serialized (see LycheeDAO.createAlbum)
+        self.albumlock = threading.Lock()
+
+    def connect(self):
+        """
+        Open a new connection
+        """
+        return MySQLdb.connect(host=self.conf["dbHost"],
+                               user=self.conf["dbUser"],
+                               passwd=self.conf["dbPassword"],
+                               db=self.conf["db"])
+
+    def check(self, db):
+        """
+        Returns db if it is still alive, a new connection otherwise
+        """
+        try:
+            db.ping()
+            return db
+        except MySQLdb.Error:
+            if self.conf["verbose"]:
+                print "INFO db connection lost, reconnecting"
+            self.discard(db)
+            return self.connect()
+
+    def discard(self, db):
+        """
+        Close a connection, ignoring errors
+        """
+        try:
+            db.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """
+        Get a live connection, waits if size connections are already in use
+        """
+        self.slots.acquire()
+        try:
+            try:
+                db = self.idle.get_nowait()
+            except Queue.Empty:
+                return self.connect()
+            return self.check(db)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, db):
+        """
+        Give back a connection acquired with acquire
+        """
+        try:
+            db.rollback()
+            self.idle.put(db)
+        except MySQLdb.Error:
+            self.discard(db)
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        with pool.connection() as db: ...
+        """
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def close(self):
+        """
+        Close idle connections
+        """
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except Queue.Empty:
+                break
 
 
 class LycheeDAO:
@@ -15,42 +171,62 @@ class LycheeDAO:
     db = None
     conf = None
     albumslist = {}
-
-    def __init__(self, conf):
+    photoslist = {}
+    checksumslist = {}
+    photosbyid = {}
+    albumphotos = {}
+    urlrefs = {}
+    pendingphotos = []
+    pendingsince = None
+    onPhotosInserted = None
+    pendingerase = []
+    erasesince = None
+    onPhotosErased = None
+    pool = None
+    dirty = False
+    lastuse = 0
+
+    def __init__(self, conf, pool=None):
         """
         Takes a dictionnary of conf as input
+        and optionnaly a ConnectionPool shared with other LycheeDAO
         """
 
         self.conf = conf
-        self.db = MySQLdb.connect(host=self.conf["dbHost"],
-                                  user=self.conf["dbUser"],
-                                  passwd=self.conf["dbPassword"],
-                                  db=self.conf["db"])
+        self.ownpool = pool is None
+        self.pool = pool or ConnectionPool(conf)
+        self.db = self.pool.acquire()
+        self.dirty = False
+        self.lastuse = time.time()
+
+        self.albumslist = {}
+        self.photoslist = {}
+        self.checksumslist = {}
+        self.photosbyid = {}
+        self.albumphotos = {}
+        self.urlrefs = {}
+        self.pendingphotos = []
+        # (photo id, its index entry) erased from the index, not from db yet (see flushErased)
+        self.pendingerase = []
+        self.erasedalbums = set()
 
         if self.conf["dropdb"]:
             self.dropAll()
 
         self.loadAlbumList()
+        self.loadPhotoList()
 
     def getAlbumMinMaxIds(self):
         """
         returns min, max album ids
         """
-        min_album_query = "select min(id) from lychee_albums"
-        max_album_query = "select max(id) from lychee_albums"
         try:
             min = -1
             max = -1
-            cur = self.db.cursor()
-            cur.execute(min_album_query)
-            rows = cur.fetchall()
-            for row in rows:
-                min = row[0]
-
-            cur.execute(max_album_query)
+            cur = self.execute("minMaxAlbumIds")
             rows = cur.fetchall()
             for row in rows:
-                max = row[0]
+                min, max = row
 
             if self.conf["verbose"]:
                 print "INFO min, max album id: ", min, " to ", max
@@ -63,16 +239,17 @@ class LycheeDAO:
         finally:
             return res
 
-    def updateAlbumDate(self, albumid, newdate):
+    def updateAlbumDate(self, albumid, newdate, commit=True):
         """
         Update album date to an arbitrary date
+        Set commit to False to group several updates in a transaction, then call commit
         """
+        self.flush()
         res = True
-        qry = "update lychee_albums set sysstamp= '" + newdate.strftime('%s') + "' where id=" + str(albumid)
         try:
-            cur = self.db.cursor()
-            cur.execute(qry)
-            self.db.commit()
+            self.execute("updateAlbumDate", (newdate.strftime('%s'), albumid))
+            if commit:
+                self.commit()
             if self.conf["verbose"]:
                 print "INFO album id sysstamp changed to: ", newdate
         except Exception:
@@ -82,18 +259,24 @@ class LycheeDAO:
         finally:
             return res
 
-    def changeAlbumId(self, oldid, newid):
+    def changeAlbumId(self, oldid, newid, commit=True):
         """
         Change albums id based on album titles (to affect display order)
+        Set commit to False to group several changes in a transaction, then call commit
         """
+        self.flush()
         res = True
-        photo_query = "update lychee_photos set album = " + str(newid) + " where album = " + str(oldid)
-        album_query = "update lychee_albums set id = " + str(newid) + " where id = " + str(oldid)
         try:
-            cur = self.db.cursor()
-            cur.execute(photo_query)
-            cur.execute(album_query)
-            self.db.commit()
+            self.execute("movePhotosToAlbum", (newid, oldid))
+            self.execute("changeAlbumId", (newid, oldid))
+            if commit:
+                self.commit()
+            for title, albumid in self.albumslist.items():
+                if albumid == oldid:
+                    self.albumslist[title] = newid
+            for photoid in self.listAlbumPhotoIds(oldid):
+                album, title, url, checksum = self.unindexPhoto(photoid)
+                self.indexPhoto(photoid, newid, title, url, checksum)
             if self.conf["verbose"]:
                 print "INFO album id changed: ", oldid, " to ", newid
         except Exception:
@@ -104,6 +287,55 @@ class LycheeDAO:
         finally:
             return res
 
+    def execute(self, name, params=None, many=False):
+        """
+        Run a statement of QUERIES
+        The connection is checked if it was idle for conf "dbPingInterval" seconds (default 60),
+        if it is lost anyway the statement is retried on a new connection unless
+        a transaction was in progress (which is lost then)
+        Parameters:
+        - name: the statement name in QUERIES
+        - params: the statement parameters tuple (a list of tuples with many)
+        - many: use executemany
+        Returns the cursor
+        """
+        if time.time() - self.lastuse > self.conf.get("dbPingInterval", 60) and not self.dirty:
+            self.db = self.pool.check(self.db)
+        try:
+            cur = self.run(name, params, many)
+        except MySQLdb.OperationalError as e:
+            if e.args[0] not in CONNECTION_LOST:
+                raise
+            lost = self.dirty
+            self.reconnect()
+            if lost:
+                raise
+            cur = self.run(name, params, many)
+        self.lastuse = time.time()
+        if not QUERIES[name].startswith("select"):
+            self.dirty = True
+        return cur
+
+    def run(self, name, params, many):
+        cur = self.db.cursor()
+        query = QUERIES[name]
+        if "{ids}" in query:
+            query = query.format(ids=", ".join(["%s"] * len(params)))
+        if many:
+            cur.executemany(query, params)
+        else:
+            cur.execute(query, params)
+        return cur
+
+    def reconnect(self):
+        """
+        Replace the current connection by a new one
+        """
+        print "WARNING db connection lost, reconnecting"
+        self.pool.discard(self.db)
+        self.db = self.pool.connect()
+        self.dirty = False
+
     def loadAlbumList(self):
         """
         retrieve all albums in a dictionnary key=title value=id
@@ -111,23 +343,93 @@ class LycheeDAO:
         returns self.albumlist
         """
         # Load album list
-        cur = self.db.cursor()
-        cur.execute("SELECT title,id from lychee_albums")
+        cur = self.execute("listAlbums")
         rows = cur.fetchall()
         for row in rows:
-            self.albumslist[row[0]] = row[1]
+            # if an album title is duplicated, the first album is used (see createAlbum)
+            self.albumslist.setdefault(row[0], row[1])
 
         if self.conf['verbose']:
             print "INFO album list in db:", self.albumslist
         return self.albumslist
 
+    def loadPhotoList(self):
+        """
+        retrieve all photos and index them in memory:
+        - self.photoslist: key=(album id, title) value=photo id, album ids are longs (see albumKey)
+        - self.checksumslist: key=checksum value=set of photo ids
+        - self.photosbyid: key=photo id value=(album id, title, url, checksum)
+        - self.albumphotos: key=album id value=set of photo ids
+        - self.urlrefs: key=url value=number of photos using the uploaded files
+        The index is kept up to date by this class so that existence
+        and duplicate checks never hit the db
+        returns self.photoslist
+        """
+        cur = self.execute("listPhotos")
+        for row in cur.fetchall():
+            self.indexPhoto(*row)
+
+        if self.conf['verbose']:
+            print "INFO photos in db:", len(self.photosbyid)
+        return self.photoslist
+
+    def indexPhoto(self, photoid, albumid, title, url, checksum):
+        """
+        Add a photo to the in memory index
+        """
+        albumid = albumKey(albumid)
+        self.photoslist[(albumid, title)] = photoid
+        self.checksumslist.setdefault(checksum, set()).add(photoid)
+        self.photosbyid[photoid] = (albumid, title, url, checksum)
+        self.albumphotos.setdefault(albumid, set()).add(photoid)
+        self.urlrefs[url] = self.urlrefs.get(url, 0) + 1
+
+    def unindexPhoto(self, photoid):
+        """
+        Remove a photo from the in memory index
+        Returns its (album id, title, url, checksum) or None if it was not indexed
+        """
+        photo = self.photosbyid.pop(photoid, None)
+        if photo is None:
+            return None
+        albumid, title, url, checksum = photo
+        if self.photoslist.get((albumid, title)) == photoid:
+            del self.photoslist[(albumid, title)]
+        ids = self.checksumslist.get(checksum)
+        if ids is not None:
+            ids.discard(photoid)
+            if not ids:
+                del self.checksumslist[checksum]
+        ids = self.albumphotos.get(albumid)
+        if ids is not None:
+            ids.discard(photoid)
+            if not ids:
+                del self.albumphotos[albumid]
+        if self.urlrefs.get(url, 0) > 1:
+            self.urlrefs[url] -= 1
+        else:
+            self.urlrefs.pop(url, None)
+        return photo
+
+    def listAlbumPhotoIds(self, albumid):
+        """
+        Returns the ids of the photos of an album
+        """
+        return list(self.albumphotos.get(albumKey(albumid), ()))
+
+    def maxPhotoId(self):
+        """
+        Returns the highest photo id in db, 0 if there is no photo
+        """
+        return max(self.photosbyid) if self.photosbyid else 0
+
     def albumExists(self, album_name):
         """
         Check if an album exists based on its name
         Parameters: an album properties list. At least the name should be specified
         Returns None or the albumid if it exists
         """
-        return self.albumslist[album_name]
+        return self.albumslist.get(album_name)
 
     def photoExists(self, photo):
         """
@@ -136,111 +438,235 @@ class LycheeDAO:
         - photo: a valid LycheePhoto object
         Returns a boolean
         """
-        res = False
-        try:
-            query = ("select * from lychee_photos where album='" + str(photo.albumid) +
-                     "' and title = '" + photo.originalname + "'")
-            cur = self.db.cursor()
-            cur.execute(query)
-            row = cur.fetchall()
-            if len(row) != 0:
-                res = True
+        return self.photoId(photo.albumid, photo.originalname) is not None
 
-        except Exception:
-            print "ERROR photoExists:", photo.srcfullpath, "won't be added to lychee"
-            traceback.print_exc()
-            res = True
-        finally:
-            return res
+    def photoId(self, album_id, title):
+        """
+        Look for a photo by album and title
+        Parameters:
+        - album_id: the album id
+        - title: the photo title
+        Returns the photo id or None
+        """
+        return self.photoslist.get((albumKey(album_id), title))
+
+    def photoIdByChecksum(self, checksum):
+        """
+        Look for a photo with the same content
+        Parameter:
+        - checksum: a photo file checksum
+        Returns the id of a photo with this checksum or None
+        """
+        ids = self.checksumslist.get(checksum)
+        if not ids:
+            return None
+        return min(ids)
+
+    def urlRefCount(self, url):
+        """
+        Count the photos sharing uploaded files (see conf "dedup")
+        Parameter:
+        - url: a photo url
+        Returns the number of photos in db using this url
+        """
+        return self.urlrefs.get(url, 0)
 
     def createAlbum(self, album):
         """
-        Creates an album
+        Creates an album, unless it is already in the albums list or in db
+        Creations of an album are serialized between the LycheeDAO sharing a ConnectionPool, and between
+        lycheesync processes by a mysql named lock (GET_LOCK, waited for 10 seconds): the album is only
+        inserted if no album has its title, then its id is read back, so that they all get the same album.
+        Albums created by lychee itself without the lock may still duplicate it, the oldest one is used then
         Parameter:
         - album: the album properties list, at least the name should be specified
-        Returns the created albumid or None
+        Returns the album id or None
         """
-        album['id'] = None
-        query = ("insert into lychee_albums (title, sysstamp, public, password) values ('" +
-                 album['name'] + "','" + datetime.datetime.now().strftime('%s') + "'," +
-                 str(self.conf["publicAlbum"]) + ", NULL)")
-        try:
-            cur = self.db.cursor()
-            cur.execute(query)
-            self.db.commit()
-        except Exception:
-            "already exists"
+        album['id'] = self.albumslist.get(album['name'])
+        if album['id'] is not None:
+            return album['id']
+        # mysql limits lock names to 64 characters
+        lockname = "lycheesync_album_" + hashlib.md5(album['name']).hexdigest()
+        with self.pool.albumlock:
+            locked = False
+            try:
+                locked = self.execute("lockAlbum", (lockname,)).fetchone()[0] == 1
+                if not locked:
+                    print "WARNING album lock not acquired, creating it anyway:", album['name']
+                cur = self.execute("createAlbum", (album['name'], datetime.datetime.now().strftime('%s'),
+                                                   self.conf["publicAlbum"], album['name']))
+                created = cur.rowcount > 0
+                self.commit()
+                row = self.execute("albumIdByTitle", (album['name'],)).fetchone()
+                album['id'] = row[0] if row else None
+                if album['id'] is not None:
+                    self.albumslist[album['name']] = album['id']
+                if self.conf["verbose"] and created:
+                    print "INFO album created:", album
+
+            except Exception:
+                print "createAlbum", Exception
+                traceback.print_exc()
+                self.rollback()
+                album['id'] = None
+            finally:
+                if locked:
+                    try:
+                        self.execute("unlockAlbum", (lockname,))
+                    except Exception:
+                        print "createAlbum", Exception
+                        traceback.print_exc()
+        return album['id']
+
+    def erasePhoto(self, photo_name, album_id):
+        """
+        Erase a photo, and its album if it was the last photo in it
+        The erasure is queued and sent to the db with others (see queueErase)
+        Parameters:
+        - photo_name: the photo title
+        - album_id: its album id
+        Returns nothing
+        """
+        photoid = self.photoId(album_id, photo_name)
+        if photoid is not None:
+            self.queueErase([photoid])
+
+    def queueErase(self, photoids):
+        """
+        Queue the erasure of photos, they are removed from the index right away
+        and from the db with others (see flushErased), like inserts are (conf "dbBatchSize" and "dbBatchDelay")
+        Albums left without photo are erased along
+        Parameters:
+        - photoids: a list of photo ids
+        Returns the number of photos queued
+        """
+        queued = 0
+        if not self.pendingerase and not self.erasedalbums:
+            self.erasesince = time.time()
+        for photoid in photoids:
+            photo = self.unindexPhoto(photoid)
+            if photo is None:
+                continue
+            self.pendingerase.append((photoid, photo))
+            self.erasedalbums.add(photo[0])
+            queued += 1
+        if len(self.pendingerase) >= self.conf.get("dbBatchSize", 100):
+            self.flushErased()
+        return queued
+
+    def movePhoto(self, photoid, album_id, title, star):
+        """
+        Move a photo to another album and/or rename it, its album is erased if it is now empty
+        Parameters:
+        - photoid: the photo id
+        - album_id: its new album id
+        - title: its new title
+        - star: its new star flag
+        Returns a boolean
+        """
+        self.flush()
+        res = True
         try:
-            query = "select id from lychee_albums where title='" + album['name'] + "'"
-            cur.execute(query)
-            row = cur.fetchone()
-            self.albumslist['name'] = row[0]
-            album['id'] = row[0]
+            self.execute("movePhoto", (album_id, title, star, photoid))
+            oldalbum, oldtitle, url, checksum = self.unindexPhoto(photoid)
+            self.indexPhoto(photoid, album_id, title, url, checksum)
+            if oldalbum != album_id and not self.listAlbumPhotoIds(oldalbum):
+                self.execute("eraseAlbum", (oldalbum,))
+                self.forgetAlbum(oldalbum)
+            self.commit()
             if self.conf["verbose"]:
-                print "INFO album created:", album
-
+                print "INFO photo moved:", oldtitle, "to", title, "in album", album_id
         except Exception:
-            print "createAlbum", Exception
+            res = False
+            print "movePhoto", Exception
             traceback.print_exc()
-            album['id'] = None
+            self.rollback()
         finally:
-            return album['id']
+            return res
 
-    def erasePhoto(self, photo_name, album_id):
-        query = "delete from lychee_photos where album = " + str(album_id) + " and title = '" + photo_name + "'"
-        selquery = "select id from lychee_photos where album = " + str(album_id) + ''
-        albquery = "delete from lychee_albums where id = " + str(album_id) + ''
+    def renameAlbum(self, album_id, title):
+        """
+        Rename an album
+        Parameters:
+        - album_id: the album id
+        - title: its new title
+        Returns a boolean
+        """
+        res = True
         try:
-            cur = self.db.cursor()
-            cur.execute(query)
-
-            cur.execute(selquery)
-            rows = cur.fetchall()
-
-            if not rows:
-                cur.execute(albquery)
-
-            self.db.commit()
+            self.execute("renameAlbum", (title, album_id))
+            self.commit()
+            self.forgetAlbum(album_id)
+            self.albumslist[title] = album_id
+            if self.conf["verbose"]:
+                print "INFO album renamed:", album_id, "to", title
         except Exception:
-            print "Erasing " + photo_name + " failed."
+            res = False
+            print "renameAlbum", Exception
+            traceback.print_exc()
+        finally:
+            return res
 
-    def eraseAlbum(self, album):
+    def mergeAlbum(self, oldid, newid):
         """
+        Move every photo of an album to another one and erase it
         Parameters:
-        - album: the album properties list to erase.  At least its id must be provided
-        Return list of the erased photo url
+        - oldid: the album to erase
+        - newid: the album receiving the photos
+        Returns a boolean
         """
-        res = []
-        query = "delete from lychee_photos where album = " + str(album['id']) + ''
-        selquery = "select url from lychee_photos where album = " + str(album['id']) + ''
-        albquery = "delete from lychee_albums where id = " + str(album['id']) + ''
+        self.flush()
+        res = True
         try:
-            cur = self.db.cursor()
-            cur.execute(selquery)
-            rows = cur.fetchall()
-            for row in rows:
-                res.append(row[0])
-            cur.execute(query)
-            cur.execute(albquery)
-            self.db.commit()
+            self.execute("movePhotosToAlbum", (newid, oldid))
+            self.execute("eraseAlbum", (oldid,))
+            self.commit()
+            for photoid in self.listAlbumPhotoIds(oldid):
+                album, title, url, checksum = self.unindexPhoto(photoid)
+                self.indexPhoto(photoid, newid, title, url, checksum)
+            self.forgetAlbum(oldid)
             if self.conf["verbose"]:
-                print "INFO album erased: ", album
+                print "INFO album merged:", oldid, "into", newid
         except Exception:
-            print "eraseAlbum", Exception
+            res = False
+            print "mergeAlbum", Exception
             traceback.print_exc()
+            self.rollback()
         finally:
             return res
 
+    def forgetAlbum(self, album_id):
+        """
+        Remove an album from the in memory albums list
+        """
+        for title, albumid in self.albumslist.items():
+            if albumid == album_id:
+                del self.albumslist[title]
+
+    def eraseAlbum(self, album):
+        """
+        Erase an album and its photos, queued like photo erasures (see queueErase)
+        Parameters:
+        - album: the album properties list to erase.  At least its id must be provided
+        Return the number of erased photos
+        """
+        if not self.pendingerase and not self.erasedalbums:
+            self.erasesince = time.time()
+        # erased even if it has no photo left
+        self.erasedalbums.add(albumKey(album['id']))
+        res = self.queueErase(self.listAlbumPhotoIds(album['id']))
+        if self.conf["verbose"]:
+            print "INFO album erased: ", album
+        return res
+
     def listAllPhoto(self):
         """
         Lists all photos in leeche db (used to delete all files)
         Return a photo url list
         """
         res = []
-        selquery = "select url from lychee_photos"
         try:
-            cur = self.db.cursor()
-            cur.execute(selquery)
+            cur = self.execute("listPhotoUrls")
             rows = cur.fetchall()
             for row in rows:
                 res.append(row[0])
@@ -250,58 +676,173 @@ class LycheeDAO:
         finally:
             return res
 
+    def listPhotos(self):
+        """
+        Lists all photos in leeche db (used to rebuild the catalog), from the in memory index
+        Return a list of (album, title, id, url, checksum) tuples
+        """
+        return [(albumid, title, photoid, url, checksum)
+                for photoid, (albumid, title, url, checksum) in self.photosbyid.items()]
+
     def addFileToAlbum(self, photo):
         """
         Add a photo to an album
+        The insert is queued and sent to the db with others (see flush),
+        when conf "dbBatchSize" photos are queued or the oldest one waits for more than
+        conf "dbBatchDelay" seconds (see flushIfDue)
         Parameter:
         - photo: a valid LycheePhoto object
         Returns a boolean
         """
-        res = True
         # print photo
+        values = photo.toRow(self.conf["publicAlbum"])
+
+        if not self.pendingphotos:
+            self.pendingsince = time.time()
+        self.pendingphotos.append((photo, values))
+        # pending photos are already visible to photoExists
+        self.indexPhoto(long(photo.id), photo.albumid, photo.originalname, photo.url, photo.checksum)
+
+        if len(self.pendingphotos) >= self.conf.get("dbBatchSize", 100):
+            return self.flush()
+        return True
+
+    def flush(self):
+        """
+        Send queued inserts then queued erasures to the db
+        Returns a boolean
+        """
+        inserted = self.flushInserts()
+        return self.flushErased() and inserted
+
+    def flushInserts(self):
+        """
+        Insert every queued photo in a single multi-row insert and transaction
+        self.onPhotosInserted, if set, is called with the list of inserted LycheePhoto
+        Returns a boolean
+        """
+        if not self.pendingphotos:
+            return True
+        photos = self.pendingphotos
+        self.pendingphotos = []
+
+        inserted = [photo for photo, values in photos]
         try:
-            stamp = parse(photo.exif.takedate + ' ' + photo.exif.taketime).strftime('%s')
+            # MySQLdb turns executemany of an insert into a single multi-row insert
+            with metrics.timed("dbInsert"):
+                self.execute("addPhoto", [values for photo, values in photos], many=True)
+                self.commit()
         except Exception:
-            stamp = datetime.datetime.now().strftime('%s')
-
-        query = ("insert into lychee_photos " +
-                 "(id, url, public, type, width, height, " +
-                 "size, star, " +
-                 "thumbUrl, album,iso, aperture, make, " +
-                 "model, shutter, focal, takestamp, " +
-                 "description, title, checksum) " +
-                 "values " +
-                 "({}, '{}', {}, '{}', {}, {}, " +
-                 "'{}', {}, " +
-                 "'{}', '{}', '{}', '{}', '{}', " +
-                 "'{}', '{}', '{}', '{}', " +
-                 "'{}', '{}', '{}')"
-                 ).format(photo.id, photo.url, self.conf["publicAlbum"], photo.type, photo.width, photo.height,
-                          photo.size, photo.star,
-                          photo.thumbUrl, photo.albumid, photo.exif.iso, photo.exif.aperture, photo.exif.make,
-                          photo.exif.model, photo.exif.shutter, photo.exif.focal, stamp,
-                          photo.description, photo.originalname, photo.checksum)
-        # print query
-
+            print "flush", Exception
+            traceback.print_exc()
+            self.rollback()
+            if len(photos) > 1:
+                # don't let one bad photo fail the whole batch
+                inserted = []
+                for photo, values in photos:
+                    self.pendingphotos = [(photo, values)]
+                    if self.flushInserts():
+                        inserted.append(photo)
+                return len(inserted) == len(photos)
+            for photo, values in photos:
+                print "ERROR photo not added to lychee:", photo.srcfullpath
+                self.unindexPhoto(long(photo.id))
+            return False
+
+        if self.conf["verbose"]:
+            print "INFO photos inserted:", len(inserted)
+        if self.onPhotosInserted:
+            self.onPhotosInserted(inserted)
+        return True
+
+    def flushErased(self):
+        """
+        Erase every queued photo, and the albums left empty, with set based deletes in a single transaction
+        Queued inserts are flushed first: an erased photo may still wait for its insert
+        self.onPhotosErased, if set, is called with the urls no photo uses anymore, once erased
+        Erasures that failed are queued again
+        Returns a boolean
+        """
+        if not self.pendingerase and not self.erasedalbums:
+            return True
+        res = self.flushInserts()
+        erased = self.pendingerase
+        albums = self.erasedalbums
+        self.pendingerase = []
+        self.erasedalbums = set()
+
+        ids = [photoid for photoid, photo in erased]
+        # an album still has photos if some were added or moved in since
+        empty = [albumid for albumid in albums if albumid is not None and not self.albumphotos.get(albumid)]
         try:
-            cur = self.db.cursor()
-            res = cur.execute(query)
-            self.db.commit()
+            with metrics.timed("dbErase"):
+                for i in xrange(0, len(ids), IN_CHUNK):
+                    self.execute("erasePhotos", ids[i:i + IN_CHUNK])
+                for i in xrange(0, len(empty), IN_CHUNK):
+                    self.execute("eraseAlbums", empty[i:i + IN_CHUNK])
+                self.commit()
         except Exception:
-            print "addFileToAlbum", Exception
+            print "flushErased", Exception
             traceback.print_exc()
-            res = False
-        finally:
-            return res
+            self.rollback()
+            # still in db, retried once conf "dbBatchDelay" has passed again
+            self.pendingerase = erased
+            self.erasedalbums = albums
+            self.erasesince = time.time()
+            return False
+
+        for albumid in empty:
+            self.forgetAlbum(albumid)
+        if self.conf["verbose"]:
+            print "INFO photos erased:", len(erased), "albums erased:", len(empty)
+        if self.onPhotosErased:
+            # files shared with photos still in lychee are kept (see conf "dedup")
+            urls = set(photo[2] for photoid, photo in erased)
+            self.onPhotosErased([url for url in urls if self.urlRefCount(url) == 0])
+        return res
+
+    def flushIfDue(self):
+        """
+        Flush queued photos if the oldest one waits for more than conf "dbBatchDelay" seconds,
+        due erasures flush the queued inserts along (see flushErased)
+        Returns a boolean
+        """
+        delay = self.conf.get("dbBatchDelay", 2)
+        res = True
+        if self.pendingphotos and time.time() - self.pendingsince >= delay:
+            res = self.flushInserts()
+        if (self.pendingerase or self.erasedalbums) and time.time() - self.erasesince >= delay:
+            res = self.flushErased() and res
+        return res
+
+    def commit(self):
+        """
+        Commit the current transaction, see the commit parameter of changeAlbumId and updateAlbumDate
+        Returns nothing
+        """
+        self.db.commit()
+        self.dirty = False
+
+    def rollback(self):
+        """
+        Rollback the current transaction
+        Returns nothing
+        """
+        try:
+            self.db.rollback()
+        except MySQLdb.Error:
+            traceback.print_exc()
+        self.dirty = False
 
     def reinitAlbumAutoIncrement(self):
 
         min, max = self.getAlbumMinMaxIds()
-        qry = "alter table lychee_albums AUTO_INCREMENT=" + str(max + 1)
+        # DDL can't take parameters
+        qry = "alter table lychee_albums AUTO_INCREMENT=" + str(int(max) + 1)
         try:
             cur = self.db.cursor()
             cur.execute(qry)
-            self.db.commit()
+            self.commit()
             if self.conf['verbose']:
                 print "INFO: reinit auto increment to", str(max + 1)
         except Exception:
@@ -310,22 +851,34 @@ class LycheeDAO:
 
     def close(self):
         """
-        Close DB Connection
+        Close DB Connection, queued photos are inserted and erased first
         Returns nothing
         """
         if self.db:
-            self.db.close()
+            self.flush()
+            self.pool.release(self.db)
+            self.db = None
+            if self.ownpool:
+                self.pool.close()
 
     def dropAll(self):
         """
         Drop all albums and photos from DB
         Returns nothing
         """
+        self.pendingphotos = []
+        self.pendingerase = []
+        self.erasedalbums = set()
         try:
-            cur = self.db.cursor()
-            cur.execute("delete from lychee_albums")
-            cur.execute("delete from lychee_photos")
-            self.db.commit()
+            self.execute("dropAlbums")
+            self.execute("dropPhotos")
+            self.commit()
+            self.albumslist.clear()
+            self.photoslist.clear()
+            self.checksumslist.clear()
+            self.photosbyid.clear()
+            self.albumphotos.clear()
+            self.urlrefs.clear()
         except Exception:
             print "dropAll", Exception
             traceback.print_exc()
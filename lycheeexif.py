@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+# exif tag id -> ExifData attribute, only the tags lychee stores are decoded
+TAGS = {
+    0x0112: "orientation",
+    0x010F: "make",
+    0x0110: "model",
+    0x0132: "datetime",
+    0x829A: "shutter",  # ExposureTime
+    0x8827: "iso",  # ISOSpeedRatings
+    0x9205: "aperture",  # MaxApertureValue
+    0x920A: "focal",  # FocalLength
+}
+
+# pointer from IFD0 to the Exif sub IFD
+EXIF_IFD = 0x8769
+
+# tiff field type -> (struct format of one value, size of one value)
+TYPES = {
+    1: ("B", 1),  # byte
+    2: ("s", 1),  # ascii
+    3: ("H", 2),  # short
+    4: ("L", 4),  # long
+    5: ("LL", 8),  # rational
+    6: ("b", 1),  # signed byte
+    8: ("h", 2),  # signed short
+    9: ("l", 4),  # signed long
+    10: ("ll", 8),  # signed rational
+}
+
+# jpeg start of frame markers, the ones holding the image dimensions
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+
+def readValue(data, order, fieldtype, count, offset):
+    """
+    Decode the value of a tiff field, the way PIL _getexif does:
+    strings without trailing nul, single values as is, rationals as (numerator, denominator)
+    Parameters:
+    - data: the tiff data
+    - order: the struct byte order
+    - fieldtype: the tiff field type
+    - count: the number of values
+    - offset: the offset of the value (or of its pointer) in data
+    Returns the value or None if it can't be read
+    """
+    fmt, size = TYPES[fieldtype]
+    total = size * count
+    if total > 4:
+        offset = struct.unpack(order + "L", data[offset:offset + 4])[0]
+    raw = data[offset:offset + total]
+    if len(raw) < total:
+        return None
+    if fieldtype == 2:
+        return raw.split("\x00", 1)[0]
+    values = struct.unpack(order + fmt * count, raw)
+    if len(fmt) == 2:
+        values = tuple(zip(values[0::2], values[1::2]))
+    if count == 1:
+        return values[0]
+    return values
+
+
+def parseTiff(data):
+    """
+    Parse the tiff structure of an exif segment, IFD0 and the Exif sub IFD
+    Parameters:
+    - data: the exif data, after the "Exif" header
+    Returns a dictionnary key=ExifData attribute (see TAGS) value=decoded value,
+    with only the tags read before the end of data if it is truncated
+    """
+    if data[:2] == "II":
+        order = "<"
+    elif data[:2] == "MM":
+        order = ">"
+    else:
+        raise ValueError("not a tiff header")
+    tags = {}
+    try:
+        ifds = [struct.unpack(order + "L", data[4:8])[0]]
+        seen = set()
+        while ifds:
+            offset = ifds.pop()
+            if offset in seen or offset + 2 > len(data):
+                continue
+            seen.add(offset)
+            count = struct.unpack(order + "H", data[offset:offset + 2])[0]
+            for i in range(count):
+                entry = offset + 2 + 12 * i
+                if entry + 12 > len(data):
+                    break
+                tag, fieldtype, n = struct.unpack(order + "HHL", data[entry:entry + 8])
+                if tag == EXIF_IFD:
+                    ifds.append(struct.unpack(order + "L", data[entry + 8:entry + 12])[0])
+                    continue
+                name = TAGS.get(tag)
+                if name is None or fieldtype not in TYPES or n == 0:
+                    continue
+                value = readValue(data, order, fieldtype, n, entry + 8)
+                if value is not None:
+                    tags[name] = value
+    except (struct.error, IndexError):
+        # truncated tiff data: keep the tags already read
+        pass
+    return tags
+
+
+def readJpegHeader(f):
+    """
+    Walk the jpeg segments up to the image data, reading only the exif (APP1)
+    and the start of frame segments
+    Parameters:
+    - f: the jpeg file, positionned after its SOI marker
+    Returns a (width, height, tags) tuple, with what was read before a truncated segment:
+    width and height are None if the start of frame segment is missing or truncated
+    """
+    width = height = None
+    tags = {}
+    try:
+        while True:
+            byte = f.read(1)
+            if not byte:
+                break
+            if byte != "\xff":
+                raise ValueError("bad jpeg marker")
+            marker = f.read(1)
+            # fill bytes
+            while marker == "\xff":
+                marker = f.read(1)
+            if not marker:
+                break
+            marker = ord(marker)
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                # no length
+                continue
+            if marker in (0xD9, 0xDA):
+                # end of image, start of scan: no more header
+                break
+            raw = f.read(2)
+            if len(raw) < 2:
+                break
+            length = struct.unpack(">H", raw)[0] - 2
+            if marker == 0xE1 and not tags:
+                segment = f.read(length)
+                if segment[:6] == "Exif\x00\x00":
+                    tags = parseTiff(segment[6:])
+            elif marker in SOF_MARKERS:
+                segment = f.read(length)
+                height, width = struct.unpack(">HH", segment[1:5])
+                # the exif segment comes first
+                break
+            else:
+                f.seek(length, 1)
+    except (struct.error, IndexError):
+        # truncated segment
+        pass
+    return width, height, tags
+
+
+def readHeader(path):
+    """
+    Read the dimensions and exif tags of a photo from its file header, without decoding it
+    jpeg, png and gif are supported
+    Parameters:
+    - path: the photo full path
+    Returns a (width, height, tags) tuple, width and height are None for other formats
+    and tags is a dictionnary (see parseTiff), empty if there is no exif.
+    Raises IOError if the file can't be read, ValueError if its header is malformed
+    """
+    with open(path, "rb") as f:
+        head = f.read(26)
+        if head[:2] == "\xff\xd8":
+            f.seek(2)
+            return readJpegHeader(f)
+    if head[:8] == "\x89PNG\r\n\x1a\n" and head[12:16] == "IHDR" and len(head) >= 24:
+        width, height = struct.unpack(">LL", head[16:24])
+        return width, height, {}
+    if head[:6] in ("GIF87a", "GIF89a") and len(head) >= 10:
+        width, height = struct.unpack("<HH", head[6:10])
+        return width, height, {}
+    return None, None, {}
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import os
+import re
+import time
+from lycheedao import ConnectionPool
+from lycheeutils import iterDirectory, removeFiles
+
+# uploaded file names: md5 hex digest url, @2x for the big thumbnail, .tmp- for an interrupted thumbnail write
+UPLOAD_NAME = re.compile(r"^(\.tmp-)?([0-9a-f]{32})(@2x)?\.[0-9a-z]+$")
+# shards are the first hex digit of the urls
+SHARDS = "0123456789abcdef"
+
+
+class GarbageCollector:
+
+    """
+    Find the files of lychee uploads/big and uploads/thumb no photo of lychee db uses
+    (photos deleted or moved by an older version, interrupted imports), report them and delete them
+    Memory is bounded: urls are processed by shard (their first hex digit), each shard is read from db
+    by pages of conf "gcPageSize" rows (default 10000) into a set of 16 bytes digests,
+    then the upload directories are scanned for the files of that shard.
+    Done shards are recorded in a checkpoint file (conf "gcCheckpoint", next to the catalog by default),
+    Ctrl+C stops the job and running it again resumes it
+    Files changed less than conf "gcGrace" seconds ago (default 3600) are kept: they may belong to
+    a photo being imported by a running lycheesync
+    """
+
+    def __init__(self, conf):
+        """
+        Takes a dictionnary of conf as input
+        """
+        self.conf = conf
+        self.uploads = os.path.join(self.conf["lycheepath"], "uploads")
+        self.pageSize = self.conf.get("gcPageSize", 10000)
+        self.grace = self.conf.get("gcGrace", 3600)
+        self.checkpoint = self.conf.get("gcCheckpoint", self.conf["catalog"] + ".gc")
+        self.orphans = 0
+        self.size = 0
+        self.removed = 0
+
+    def loadCheckpoint(self):
+        """
+        Returns the dictionnary shard -> (orphans, size, removed) of the shards done by a previous run
+        """
+        done = {}
+        if not os.path.exists(self.checkpoint):
+            return done
+        with open(self.checkpoint) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 4:
+                    done[fields[0]] = tuple(int(field) for field in fields[1:])
+        return done
+
+    def listUrls(self, db, shard):
+        """
+        Read the urls of a shard from db, by pages
+        Parameters:
+        - db: a db connection
+        - shard: the first hex digit of the urls
+        Returns the set of their md5 digests
+        """
+        digests = set()
+        cur = db.cursor()
+        lastid = -1
+        while True:
+            cur.execute("select id, url from lychee_photos where id > %s and url like %s order by id limit %s",
+                        (lastid, shard + "%", self.pageSize))
+            rows = cur.fetchall()
+            for photoid, url in rows:
+                match = UPLOAD_NAME.match(url.lower())
+                if match:
+                    digests.add(binascii.unhexlify(match.group(2)))
+            if len(rows) < self.pageSize:
+                return digests
+            lastid = rows[-1][0]
+
+    def findOrphans(self, directory, shard, digests):
+        """
+        Scan an upload directory for the files of a shard no url uses
+        Parameters:
+        - directory: "big" or "thumb"
+        - shard: the first hex digit of the urls
+        - digests: the set of the digests of the urls of the shard
+        Yields the (path, size) of orphan files
+        """
+        now = time.time()
+        for entry in iterDirectory(os.path.join(self.uploads, directory)):
+            match = UPLOAD_NAME.match(entry.name)
+            if not match or match.group(2)[0] != shard:
+                continue
+            if binascii.unhexlify(match.group(2)) in digests:
+                continue
+            try:
+                st = os.lstat(entry.path)
+            except OSError:
+                continue
+            # ctime: a hard linked photo keeps the mtime of its source
+            if now - st.st_ctime < self.grace:
+                continue
+            yield entry.path, st.st_size
+
+    def collectShard(self, db, shard, dryrun):
+        """
+        Report and delete the orphan files of a shard
+        Returns its (orphans, size, removed) counts
+        """
+        digests = self.listUrls(db, shard)
+        orphans = size = removed = 0
+        for directory in ("big", "thumb"):
+            paths = []
+            for path, filesize in self.findOrphans(directory, shard, digests):
+                orphans += 1
+                size += filesize
+                if self.conf["verbose"]:
+                    print "INFO orphan file:", path
+                if not dryrun:
+                    paths.append(path)
+                    if len(paths) >= 1000:
+                        removed += removeFiles(paths)
+                        paths = []
+            removed += removeFiles(paths)
+        return orphans, size, removed
+
+    def run(self, dryrun=False):
+        """
+        Collect the orphan files of every shard not done yet
+        Parameters:
+        - dryrun: only report orphan files, nothing is deleted nor recorded
+        Returns True if the job is complete
+        """
+        done = {} if dryrun else self.loadCheckpoint()
+        if done:
+            print "INFO gc: resuming,", len(done), "shards of", len(SHARDS), "already done"
+        for orphans, size, removed in done.values():
+            self.orphans += orphans
+            self.size += size
+            self.removed += removed
+
+        dbpool = ConnectionPool(self.conf, 1)
+        checkpoint = None if dryrun else open(self.checkpoint, 'a')
+        complete = False
+        try:
+            for shard in SHARDS:
+                if shard in done:
+                    continue
+                with dbpool.connection() as db:
+                    orphans, size, removed = self.collectShard(db, shard, dryrun)
+                self.orphans += orphans
+                self.size += size
+                self.removed += removed
+                if checkpoint:
+                    checkpoint.write("%s %d %d %d\n" % (shard, orphans, size, removed))
+                    checkpoint.flush()
+                if self.conf["verbose"]:
+                    print "INFO gc: shard %s done, %d orphan files" % (shard, orphans)
+            complete = True
+        except KeyboardInterrupt:
+            print "INFO gc: cancelled, run it again to resume"
+        finally:
+            if checkpoint:
+                checkpoint.close()
+            dbpool.close()
+
+        print "INFO gc: %d orphan files, %.1f MB, %d deleted" % (self.orphans, self.size / 1048576.0, self.removed)
+        if complete and not dryrun:
+            # next run starts over
+            os.remove(self.checkpoint)
+        return complete
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+# lychee photo ids are 14 digits: the upload time in seconds (10 digits) then 4 digits,
+# used here as a sequence number (3 digits) and the slot of the allocator (1 digit)
+SEQUENCES = 1000
+SLOTS = 10
+
+
+class IdAllocator:
+
+    """
+    Hands out unique, increasing, lychee formatted photo ids
+    Ids are made of the clock, a sequence number and the allocator slot:
+    allocators using different slots (one per process) never give the same id, without talking to each other.
+    When more than 1000 ids are needed in a second, the next seconds are used in advance,
+    and a clock going backwards is ignored, so that ids always increase
+    """
+
+    def __init__(self, slot=0):
+        """
+        Parameters:
+        - slot: the allocator slot, from 0 to 9
+        """
+        if not 0 <= slot < SLOTS:
+            raise ValueError("id allocator slot must be between 0 and 9")
+        self.slot = slot
+        self.lock = threading.Lock()
+        # last (second, sequence) used, as second * SEQUENCES + sequence
+        self.last = 0
+
+    def advance(self, photoid):
+        """
+        Make sure ids are allocated after a given one, like the highest id in db
+        Parameters:
+        - photoid: a photo id
+        Returns nothing
+        """
+        with self.lock:
+            self.last = max(self.last, long(photoid) // SLOTS)
+
+    def allocate(self, count):
+        """
+        Allocate ids in bulk
+        Parameters:
+        - count: the number of ids needed
+        Returns a list of ids (strings of 14 digits)
+        """
+        with self.lock:
+            first = max(self.last + 1, long(time.time()) * SEQUENCES)
+            self.last = first + count - 1
+        return [str((tick * SLOTS) + self.slot) for tick in xrange(first, first + count)]
+
+    def next(self):
+        """
+        Returns a new id (a string of 14 digits)
+        """
+        return self.allocate(1)[0]
+
+
+# allocator of the photos created without an id (see LycheePhoto)
+allocator = IdAllocator()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import Queue
+import signal
+import threading
+import time
+import traceback
+from lycheeid import allocator
+from lycheemetrics import metrics
+from lycheemodel import LycheePhoto
+
+
+# LycheeSyncer of the current worker process (see initWorker)
+worker_syncer = None
+
+
+def initWorker(conf):
+    """
+    Initialize the current process to render photos
+    """
+    global worker_syncer
+    # imported here: lycheesyncer depends on this module
+    from lycheesyncer import LycheeSyncer
+    worker_syncer = LycheeSyncer(conf)
+
+
+def initPoolWorker(conf):
+    """
+    Initialize an import worker process
+    Ctrl+C is left to the main process which will close the pool
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # stage durations are sent back to the main process along with each result (see runJob)
+    metrics.startBuffering()
+    initWorker(conf)
+
+
+def runJob(func, args):
+    """
+    Run an import job in a worker process
+    Returns (job result, stage durations measured during the job)
+    """
+    result = func(*args)
+    return result, metrics.drain()
+
+
+def identifyPhoto(conf, photoname, album, photoid):
+    """
+    First step of a photo import in dedup mode (conf "dedup"): exif parsing and checksum,
+    so that the writer thread can tell if its uploaded files already exist.
+    Runs in an import worker process (or inline if workers is 0)
+    Parameters:
+    - conf: the conf dictionnary
+    - photoname: the photo file name
+    - album: the album properties list, path and name should be specified
+    - photoid: the photo id
+    Returns a LycheePhoto with its checksum computed or None on error
+    """
+    try:
+        with metrics.timed("photo"):
+            photo = LycheePhoto(conf, photoname, album, photoid)
+            photo.loadHeader()
+        with metrics.timed("checksum"):
+            photo.generateHash()
+        return photo
+    except Exception:
+        print "identifyPhoto", os.path.join(album['path'], photoname)
+        traceback.print_exc()
+        return None
+
+
+def renderPhoto(conf, photoname, album, photoid=None, photo=None):
+    """
+    The CPU bound part of a photo import: checksum, exif parsing,
+    thumbnails and file placement. No db access is done here.
+    Runs in an import worker process (or inline if workers is 0)
+    Parameters:
+    - conf: the conf dictionnary
+    - photoname: the photo file name
+    - album: the album properties list, path and name should be specified
+    - photoid: the photo id
+    - photo: the LycheePhoto if it was already read (see identifyPhoto)
+    Returns a LycheePhoto ready to be inserted in db or None on error
+    """
+    try:
+        if photo is None:
+            with metrics.timed("photo"):
+                photo = LycheePhoto(conf, photoname, album, photoid)
+                photo.loadHeader()
+        worker_syncer.makeThumbnail(photo)
+        with metrics.timed("place"):
+            worker_syncer.placeFile(photo)
+        return photo
+    except Exception:
+        print "renderPhoto", photo.srcfullpath if photo else os.path.join(album['path'], photoname)
+        traceback.print_exc()
+        return None
+
+
+class LycheeImporter:
+
+    """
+    Import engine fed by the GalleryHandler
+    CPU bound work (see renderPhoto) is done by a pool of worker processes
+    Every db operation is funneled to a single writer thread so that
+    the mysql connection is never shared and operations keep their order
+    In dedup mode (conf "dedup"), photos are identified first (see identifyPhoto) and only
+    rendered if no photo with the same checksum is in lychee, otherwise they share its files
+    """
+
+    def __init__(self, syncer):
+        """
+        Takes the LycheeSyncer as input, its dao is used by the writer thread
+        conf "workers" is the number of import processes (default to the cpu count),
+        0 means imports are done by the writer thread itself
+        """
+        self.syncer = syncer
+        self.conf = syncer.conf
+        self.workers = self.conf.get("workers")
+        if self.workers is None:
+            self.workers = multiprocessing.cpu_count()
+        self.queue = Queue.Queue()
+        # photos being imported
+        self.pending = set()
+        # dedup mode, checksum being rendered -> [(srcpath, photo)] waiting for its url
+        self.rendering = {}
+        # (AsyncResult, callback) of the jobs sent to the pool (see checkJobs)
+        self.jobs = []
+        self.lastcheck = time.time()
+        self.lock = threading.Lock()
+        # photo ids are allocated by this process (see lycheeid), not by the workers, so that they never collide
+        self.ids = allocator
+        self.writer = None
+        self.pool = None
+        if self.workers > 0:
+            self.pool = multiprocessing.Pool(self.workers, initPoolWorker, (self.conf,))
+        else:
+            initWorker(self.conf)
+
+    def start(self):
+        """
+        Start the db writer thread
+        """
+        self.writer = threading.Thread(target=self.writeLoop, name="lychee-db-writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def importPhoto(self, srcpath, album):
+        """
+        Queue a photo import
+        Parameters:
+        - srcpath: the photo full path
+        - album: the album properties list, path and name should be specified
+        Returns False if this photo import is already in progress
+        """
+        with self.lock:
+            if srcpath in self.pending:
+                return False
+            self.pending.add(srcpath)
+        photoname = os.path.basename(srcpath)
+        photoid = self.ids.next()
+        if self.conf.get("dedup"):
+            self.submit(identifyPhoto, (self.conf, photoname, album, photoid),
+                        lambda photo: self.write(self.dedupPhoto, srcpath, photo))
+        else:
+            self.submit(renderPhoto, (self.conf, photoname, album, photoid),
+                        lambda photo: self.photoRendered(srcpath, photo))
+        return True
+
+    def submit(self, func, args, callback):
+        """
+        Run a CPU bound job in the worker pool, or in the writer thread when there is no worker
+        Parameters:
+        - func: the job function
+        - args: its arguments
+        - callback: called with the job result
+        Returns nothing
+        """
+        if self.pool:
+            result = self.pool.apply_async(runJob, (func, args), callback=lambda result: self.jobDone(result, callback))
+            with self.lock:
+                self.jobs.append((result, callback))
+        else:
+            self.write(self.runInline, func, args, callback)
+
+    def jobDone(self, result, callback):
+        """
+        Called with each runJob result, in the pool result thread
+        """
+        result, observations = result
+        metrics.merge(observations)
+        callback(result)
+
+    def checkJobs(self):
+        """
+        Forget the finished pool jobs. The callback of a job that failed outside of its function
+        (its result could not be sent back) is called with None, so that its photo import ends
+        Returns nothing
+        """
+        with self.lock:
+            running = []
+            failed = []
+            for job in self.jobs:
+                result, callback = job
+                if not result.ready():
+                    running.append(job)
+                elif not result.successful():
+                    failed.append(job)
+            self.jobs = running
+        for result, callback in failed:
+            try:
+                result.get()
+            except Exception:
+                print "importJob", Exception
+                traceback.print_exc()
+            callback(None)
+
+    def abandonJobs(self):
+        """
+        Give up the pool jobs still running (a worker process died): their callback is called with None
+        Returns the number of jobs given up
+        """
+        with self.lock:
+            jobs = [job for job in self.jobs if not job[0].ready()]
+            self.jobs = []
+        for result, callback in jobs:
+            callback(None)
+        return len(jobs)
+
+    def runInline(self, func, args, callback):
+        """
+        Run a job in the writer thread when there is no worker
+        """
+        callback(func(*args))
+
+    def photoRendered(self, srcpath, photo):
+        """
+        Called with each renderPhoto result
+        """
+        self.write(self.insertPhoto, srcpath, photo)
+
+    def dedupPhoto(self, srcpath, photo):
+        """
+        Dedup mode: insert an identified photo right away if its files are already in lychee,
+        otherwise render it, runs in the writer thread
+        Photos with the same checksum as a photo being rendered wait for it
+        """
+        if photo is None:
+            self.insertPhoto(srcpath, None)
+        elif photo.checksum in self.rendering:
+            self.rendering[photo.checksum].append((srcpath, photo))
+        elif self.syncer.reuseUpload(photo):
+            self.insertPhoto(srcpath, photo)
+        else:
+            self.rendering[photo.checksum] = []
+            self.submit(renderPhoto, (self.conf, photo.originalname, None, photo.id, photo),
+                        lambda rendered: self.write(self.dedupRendered, srcpath, photo.checksum, rendered))
+
+    def dedupRendered(self, srcpath, checksum, photo):
+        """
+        Dedup mode: insert a rendered photo, then the photos waiting for its files,
+        runs in the writer thread
+        """
+        self.insertPhoto(srcpath, photo)
+        # once indexed (or failed) waiting photos find its url or are rendered
+        for waitingpath, waiting in self.rendering.pop(checksum, []):
+            self.dedupPhoto(waitingpath, waiting)
+
+    def insertPhoto(self, srcpath, photo):
+        """
+        Insert a rendered photo in db, runs in the writer thread
+        """
+        try:
+            if photo is None:
+                metrics.inc("import_errors")
+            elif self.syncer.importPhoto(photo):
+                metrics.inc("photos_imported")
+        finally:
+            with self.lock:
+                self.pending.discard(srcpath)
+
+    def isPending(self, srcpath):
+        """
+        Returns True if a photo import is in progress
+        """
+        with self.lock:
+            return srcpath in self.pending
+
+    def write(self, func, *args):
+        """
+        Queue a db operation, it will be run by the writer thread
+        Parameters:
+        - func: the function to call
+        - args: its arguments
+        Returns nothing
+        """
+        self.queue.put((func, args))
+
+    def registerGauges(self):
+        """
+        Expose the import backlog in the metrics
+        """
+        metrics.gauge("import_pending", lambda: len(self.pending))
+        metrics.gauge("db_queue_depth", self.queue.qsize)
+        metrics.gauge("db_pending_inserts", lambda: len(self.syncer.dao.pendingphotos))
+
+    def writeLoop(self):
+        dao = self.syncer.dao
+        while True:
+            try:
+                job = self.queue.get(timeout=1)
+            except Queue.Empty:
+                job = ()
+            if job is None:
+                break
+            if job:
+                func, args = job
+                try:
+                    func(*args)
+                except Exception:
+                    print "writeLoop", func.__name__
+                    traceback.print_exc()
+            if time.time() - self.lastcheck >= 1:
+                self.lastcheck = time.time()
+                self.checkJobs()
+            # send batched inserts to the db once they waited long enough
+            dao.flushIfDue()
+        dao.flush()
+
+    def close(self):
+        """
+        Wait for every queued import and db operation then stop workers
+        Imports are given up if none ended for conf "importTimeout" seconds (default 600)
+        Returns nothing
+        """
+        timeout = self.conf.get("importTimeout", 600)
+        abandoned = False
+        left = len(self.pending)
+        since = time.time()
+        # imports may take several steps (see dedupPhoto): wait for them before closing the pool
+        while self.pending and self.writer and self.writer.is_alive():
+            time.sleep(0.1)
+            if len(self.pending) != left:
+                left = len(self.pending)
+                since = time.time()
+            elif time.time() - since > timeout:
+                print "ERROR no import ended for", timeout, "seconds, giving up", left, "photos"
+                if not self.abandonJobs():
+                    break
+                abandoned = True
+                since = time.time()
+        if self.pool:
+            if abandoned:
+                # a lost job would make join wait forever
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+        self.queue.put(None)
+        if self.writer:
+            self.writer.join()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import BaseHTTPServer
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+# histogram buckets of the stage durations, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    """
+    Cumulative histogram of durations, prometheus style
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+
+    """
+    Counters, stage duration histograms and gauges of the sync daemon
+    Import worker processes buffer their stage durations (see startBuffering): they are
+    sent back with each job result and merged in the main process metrics (see merge)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.buffer = None
+        # told when a thread enters and leaves a timed stage (see lycheeprofile)
+        self.profiler = None
+
+    def inc(self, name, value=1):
+        """
+        Increment a counter
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        """
+        Record the duration of a stage
+        """
+        with self.lock:
+            if self.buffer is not None:
+                self.buffer.append((stage, seconds))
+                return
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        with metrics.timed("stage"): ... records the duration of the block
+        """
+        profiler = self.profiler
+        if profiler:
+            profiler.enter(stage)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+            if profiler:
+                profiler.exit(stage)
+
+    def gauge(self, name, func):
+        """
+        Register a gauge, func is called when metrics are read
+        """
+        with self.lock:
+            self.gauges[name] = func
+
+    def startBuffering(self):
+        """
+        Keep stage durations aside instead of recording them, in a worker process
+        """
+        with self.lock:
+            self.buffer = []
+
+    def drain(self):
+        """
+        Returns the buffered stage durations, and forget them
+        """
+        with self.lock:
+            if not self.buffer:
+                return []
+            buffered = self.buffer
+            self.buffer = []
+        return buffered
+
+    def merge(self, observations):
+        """
+        Record stage durations drained from a worker process
+        """
+        for stage, seconds in observations:
+            self.observe(stage, seconds)
+
+    def readGauges(self):
+        values = {}
+        with self.lock:
+            gauges = self.gauges.items()
+        for name, func in gauges:
+            try:
+                values[name] = func()
+            except Exception:
+                values[name] = 0
+        return values
+
+    def render(self):
+        """
+        Returns the metrics in the prometheus text format
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((stage, h.counts[:], h.count, h.sum) for stage, h in self.histograms.items())
+        lines = []
+        for name, value in counters:
+            lines.append("# TYPE lycheesync_%s_total counter" % name)
+            lines.append("lycheesync_%s_total %s" % (name, value))
+        if histograms:
+            lines.append("# TYPE lycheesync_stage_seconds histogram")
+        for stage, counts, count, total in histograms:
+            for bound, bucketcount in zip(BUCKETS, counts):
+                lines.append('lycheesync_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, bucketcount))
+            lines.append('lycheesync_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (stage, count))
+            lines.append('lycheesync_stage_seconds_sum{stage="%s"} %f' % (stage, total))
+            lines.append('lycheesync_stage_seconds_count{stage="%s"} %d' % (stage, count))
+        for name, value in sorted(self.readGauges().items()):
+            lines.append("# TYPE lycheesync_%s gauge" % name)
+            lines.append("lycheesync_%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns a one line summary: count and mean duration of each stage, counters and gauges
+        """
+        with self.lock:
+            stages = ["%s %d/%.1fms" % (stage, h.count, h.sum / h.count * 1000 if h.count else 0)
+                      for stage, h in sorted(self.histograms.items())]
+            counters = ["%s %s" % item for item in sorted(self.counters.items())]
+        gauges = ["%s %s" % (name, value if isinstance(value, int) else "%.1f" % value)
+                  for name, value in sorted(self.readGauges().items())]
+        return "INFO metrics: " + ", ".join(stages + counters + gauges)
+
+
+# metrics of this process
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not logged
+        pass
+
+
+class MetricsReporter:
+
+    """
+    Expose the metrics on http://127.0.0.1:<conf "metricsPort">/metrics (if set)
+    and print a summary line every conf "metricsInterval" seconds (default 60, 0 disables it)
+    """
+
+    def __init__(self, conf):
+        """
+        Takes a dictionnary of conf as input
+        """
+        self.conf = conf
+        self.port = self.conf.get("metricsPort")
+        self.interval = self.conf.get("metricsInterval", 60)
+        self.server = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        if self.port:
+            self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", self.port), MetricsHandler)
+            self.threads.append(threading.Thread(target=self.server.serve_forever, name="lychee-metrics-http"))
+        if self.interval:
+            self.threads.append(threading.Thread(target=self.run, name="lychee-metrics"))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                print metrics.summary()
+            except Exception:
+                print "MetricsReporter", Exception
+                traceback.print_exc()
+
+    def stop(self):
+        """
+        Stop serving and print a last summary
+        """
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.interval:
+            print metrics.summary()
@@ -1,18 +1,68 @@
-import time
 import hashlib
 import os
 import mimetypes
 from PIL import Image
-from PIL.ExifTags import TAGS
 import datetime
+from dateutil.parser import parse
+from lycheeexif import readHeader
+from lycheeid import allocator
+from lycheeutils import fileChecksum
 
 
-class ExifData:
+def exifValue(value):
+    """
+    exif rationals are stored as their string representation, like other exif values
+    """
+    if isinstance(value, tuple):
+        return str(value)
+    return value
+
+
+class Record(object):
+
+    """
+    Base of the slotted records below: no per instance __dict__,
+    fields and their default values are listed in the fields class attribute
+    """
+
+    __slots__ = ()
+    fields = ()
+
+    def initFields(self):
+        for name, default in self.fields:
+            setattr(self, name, default)
+
+    # slotted objects are pickled (by multiprocessing) as the tuple of their field values
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class ExifData(Record):
 
     """
     Use to store ExifData
     """
 
+    fields = (
+        ("iso", ""),
+        ("aperture", ""),
+        ("make", ""),
+        ("model", ""),
+        ("shutter", ""),
+        ("focal", ""),
+        ("_takedate", ""),
+        ("taketime", ""),
+        ("orientation", 0),
+    )
+    __slots__ = tuple(name for name, default in fields)
+
+    def __init__(self):
+        self.initFields()
+
     @property
     def takedate(self):
         """I'm the 'x' property."""
@@ -22,16 +72,6 @@ class ExifData:
     def takedate(self, value):
         self._takedate = value.replace(':', '-')
 
-    iso = ""
-    aperture = ""
-    make = ""
-    model = ""
-    shutter = ""
-    focal = ""
-    _takedate = ""
-    taketime = ""
-    orientation = 0
-
     def __str__(self):
         res = ""
         res += "iso: " + str(self.iso) + "\n"
@@ -47,46 +87,69 @@ class ExifData:
         return res
 
 
-class LycheePhoto:
+class LycheePhoto(Record):
 
     """
     Use to store photo data
+    Identity (paths, url, size, mtime...) is set at creation, the file header
+    is only read when dimensions or exif are needed (see loadHeader),
+    the checksum when it is computed (see generateHash)
     """
 
-    originalname = ""  # import_name
-    originalpath = ""
-    id = ""
-    albumname = ""
-    albumid = ""
-    thumbnailfullpath = ""
-    thumbnailx2fullpath = ""
-    title = ""
-    description = ""
-    url = ""
-    public = 0  # private by default
-    type = ""
-    width = 0
-    height = 0
-    size = ""
-    star = 0  # no star by default
-    thumbUrl = ""
-    srcfullpath = ""
-    destfullpath = ""
-    exif = None
-    sysdate = ""
-    systime = ""
-    checksum = ""
+    fields = (
+        ("originalname", ""),  # import_name
+        ("originalpath", ""),
+        ("id", ""),
+        ("albumname", ""),
+        ("albumid", ""),
+        ("thumbnailfullpath", ""),
+        ("thumbnailx2fullpath", ""),
+        ("title", ""),
+        ("url", ""),
+        ("public", 0),  # private by default
+        ("type", ""),
+        ("size", ""),
+        ("filesize", 0),  # source file size, mtime and inode when the photo was read
+        ("mtime", 0),
+        ("inode", 0),
+        ("star", 0),  # no star by default
+        ("thumbUrl", ""),
+        ("srcfullpath", ""),
+        ("destfullpath", ""),
+        ("checksum", ""),
+        ("rotated", False),  # True once the big file has been rendered upright
+        ("duplicateof", None),  # id of the photo whose uploaded files are shared (see conf "dedup")
+        # read on demand (see loadHeader)
+        ("_exif", None),
+        ("_width", 0),
+        ("_height", 0),
+        ("_description", ""),
+        ("_sysdate", ""),
+        ("_systime", ""),
+    )
+    __slots__ = tuple(name for name, default in fields)
+
+    # lychee_photos columns, in the order of toRow
+    columns = ("id", "url", "public", "type", "width", "height",
+               "size", "star",
+               "thumbUrl", "album", "iso", "aperture", "make",
+               "model", "shutter", "focal", "takestamp",
+               "description", "title", "checksum")
 
     # Compute checksum
-    def __generateHash(self):
-        sha1 = hashlib.sha1()
-        with open(self.srcfullpath, 'rb') as f:
-            sha1.update(f.read())
-            self.checksum = sha1.hexdigest()
+    def generateHash(self):
+        self.checksum = fileChecksum(self.srcfullpath)
 
-    def __init__(self, conf, photoname, album):
+    def __init__(self, conf, photoname, album, photoid=None):
+        """
+        Parameters:
+        - conf: the conf dictionnary
+        - photoname: the photo file name
+        - album: the album properties list, path, id and name should be specified
+        - photoid: the photo id, one is allocated if not given (see lycheeid)
+        """
+        self.initFields()
         # Parameters storage
-        self.conf = conf
         self.originalname = photoname
         self.originalpath = album['path']
         self.albumid = album['id']
@@ -96,10 +159,8 @@ class LycheePhoto:
         if ('star' in self.originalname) or ('cover' in self.originalname):
             self.star = 1
 
-        # Compute Photo ID
-        self.id = str(time.time())
-        self.id = self.id.replace('.', '')
-        self.id = self.id.ljust(14, '0')
+        # Photo ID
+        self.id = photoid or allocator.next()
 
         # Compute file storage url
         m = hashlib.md5()
@@ -112,59 +173,112 @@ class LycheePhoto:
 
         # src and dest fullpath
         self.srcfullpath = os.path.join(self.originalpath, self.originalname)
-        self.destfullpath = os.path.join(self.conf["lycheepath"], "uploads", "big", self.url)
+        self.destfullpath = os.path.join(conf["lycheepath"], "uploads", "big", self.url)
 
-        # Generate file checksum
-        self.__generateHash()
+        # file checksum is computed while the file is placed in lychee uploads (see LycheeSyncer.placeFile)
 
         # thumbnails already in place (see makeThumbnail)
 
         # Auto file some properties
         self.type = mimetypes.guess_type(self.originalname, False)[0]
-        self.size = os.path.getsize(self.srcfullpath)
-        self.size = str(self.size / 1024) + " KB"
-        self.sysdate = datetime.date.today().isoformat()
-        self.systime = datetime.datetime.now().strftime('%H:%M:%S')
+        st = os.stat(self.srcfullpath)
+        self.filesize = st.st_size
+        self.mtime = st.st_mtime
+        self.inode = st.st_ino
+        self.size = str(self.filesize / 1024) + " KB"
+        self._sysdate = datetime.date.today().isoformat()
+        self._systime = datetime.datetime.now().strftime('%H:%M:%S')
 
-        # Exif Data Parsing
-        self.exif = ExifData()
+    def toRow(self, public):
+        """
+        Parameters:
+        - public: the public flag of the photo in lychee
+        Returns the lychee_photos row of this photo, in the columns order
+        """
         try:
+            stamp = parse(self.exif.takedate + ' ' + self.exif.taketime).strftime('%s')
+        except Exception:
+            stamp = datetime.datetime.now().strftime('%s')
 
-            img = Image.open(self.srcfullpath)
-            w, h = img.size
-            self.width = float(w)
-            self.height = float(h)
-            if hasattr(img, '_getexif'):
-                exifinfo = img._getexif()
-                if exifinfo is not None:
-                    for tag, value in exifinfo.items():
-                        decode = TAGS.get(tag, tag)
-                        # print tag, decode, value
-                        # if decode != "MakerNote":
-                        #    print decode, value
-                        if decode == "Orientation":
-                            self.exif.orientation = value
-                        if decode == "Make":
-                            self.exif.make = value
-                        if decode == "MaxApertureValue":
-                            self.exif.aperture = value
-                        if decode == "FocalLength":
-                            self.exif.focal = value
-                        if decode == "ISOSpeedRatings":
-                            self.exif.iso = value
-                        if decode == "Model":
-                            self.exif.model = value
-                        if decode == "ExposureTime":
-                            self.exif.shutter = value
-                        if decode == "DateTime":
-                            self.exif._takedate = value.split(" ")[0]
-                            self.sysdate = self.exif.takedate
-                        if decode == "DateTime":
-                            self.exif.taketime = value.split(" ")[1]
-                            self.systime = self.exif.taketime
-                    self.description = self.sysdate + " " + self.systime
-        except IOError:
+        return (self.id, self.url, public, self.type, self.width, self.height,
+                self.size, self.star,
+                self.thumbUrl, self.albumid, exifValue(self.exif.iso), exifValue(self.exif.aperture),
+                exifValue(self.exif.make),
+                exifValue(self.exif.model), exifValue(self.exif.shutter), exifValue(self.exif.focal), stamp,
+                self.description, self.originalname, self.checksum)
+
+    def loadHeader(self):
+        """
+        Read the photo dimensions and exif data from its file header, once
+        Returns nothing
+        """
+        if self._exif is not None:
+            return
+        self._exif = ExifData()
+        try:
+            w, h, tags = readHeader(self.srcfullpath)
+            if w is None:
+                # not a jpeg, png or gif: let PIL read the header (the image is not decoded)
+                w, h = Image.open(self.srcfullpath).size
+            self._width = float(w)
+            self._height = float(h)
+        except (IOError, ValueError):
             print 'IOERROR ' + self.srcfullpath
+            return
+
+        if not tags:
+            return
+        for name in ("orientation", "make", "aperture", "focal", "iso", "model", "shutter"):
+            if name in tags:
+                setattr(self._exif, name, tags[name])
+        if tags.get("datetime"):
+            date = tags["datetime"].split(" ")
+            self._exif._takedate = date[0]
+            self._sysdate = self._exif.takedate
+            if len(date) > 1:
+                self._exif.taketime = date[1]
+                self._systime = self._exif.taketime
+        self._description = self._sysdate + " " + self._systime
+
+    @property
+    def exif(self):
+        self.loadHeader()
+        return self._exif
+
+    @property
+    def width(self):
+        self.loadHeader()
+        return self._width
+
+    @width.setter
+    def width(self, value):
+        self.loadHeader()
+        self._width = value
+
+    @property
+    def height(self):
+        self.loadHeader()
+        return self._height
+
+    @height.setter
+    def height(self, value):
+        self.loadHeader()
+        self._height = value
+
+    @property
+    def description(self):
+        self.loadHeader()
+        return self._description
+
+    @property
+    def sysdate(self):
+        self.loadHeader()
+        return self._sysdate
+
+    @property
+    def systime(self):
+        self.loadHeader()
+        return self._systime
 
     def __str__(self):
         res = ""
@@ -183,6 +297,9 @@ class LycheePhoto:
         res += "width:" + str(self.width) + "\n"
         res += "height:" + str(self.height) + "\n"
         res += "size:" + str(self.size) + "\n"
+        res += "filesize:" + str(self.filesize) + "\n"
+        res += "mtime:" + str(self.mtime) + "\n"
+        res += "inode:" + str(self.inode) + "\n"
         res += "star:" + str(self.star) + "\n"
         res += "thumbUrl:" + str(self.thumbUrl) + "\n"
         res += "srcfullpath:" + str(self.srcfullpath) + "\n"
@@ -190,5 +307,7 @@ class LycheePhoto:
         res += "sysdate:" + self.sysdate + "\n"
         res += "systime:" + self.systime + "\n"
         res += "checksum:" + self.checksum + "\n"
+        res += "rotated:" + str(self.rotated) + "\n"
+        res += "duplicateof:" + str(self.duplicateof) + "\n"
         res += "Exif: \n" + str(self.exif) + "\n"
         return res
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from lycheemetrics import metrics
+
+try:
+    # python 3.4+, or pytracemalloc on a patched python 2.7
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class LycheeProfiler:
+
+    """
+    Profile a lycheesync run, without code edits (see main.py --profile DIR)
+    - every import stage timed by lycheemetrics (photo, decode, thumbnail, place, dbInsert...)
+      runs under its own cProfile profiler: <stage>.prof files, readable with pstats, snakeviz or gprof2dot,
+      and their top functions in summary.txt
+    - the stacks of every thread are sampled every conf "profileInterval" seconds (default 0.005)
+      to stacks.collapsed, one "stage;frame;frame... count" line per stack, the input of flamegraph.pl
+    - with memory profiling (--profile-memory), the top allocation sites are written to memory.txt
+    Imports are done in the main process (conf "workers" is set to 0) so that they are seen by the profiler
+    """
+
+    # allocation sites written to memory.txt
+    topAllocations = 30
+
+    def __init__(self, conf):
+        """
+        Takes a dictionnary of conf as input, conf "profiledir" is the output directory
+        """
+        self.conf = conf
+        self.directory = self.conf["profiledir"]
+        self.memory = self.conf.get("profilememory")
+        self.interval = self.conf.get("profileInterval", 0.005)
+        # (stage, thread ident) -> cProfile.Profile
+        self.profiles = {}
+        # thread ident -> stack of the stages it is running
+        self.stages = defaultdict(list)
+        # collapsed stack -> samples
+        self.samples = defaultdict(int)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.started = None
+
+    def start(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        if self.conf.get("workers") != 0:
+            print "INFO profiling: photos are imported in the main process (workers set to 0)"
+            self.conf["workers"] = 0
+        if self.memory:
+            if tracemalloc is None:
+                print "INFO profiling: tracemalloc is not available with this python, only the peak RSS is reported"
+            else:
+                tracemalloc.start(10)
+        self.started = time.time()
+        metrics.profiler = self
+        self.sampler = threading.Thread(target=self.sampleLoop, name="lychee-profiler")
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def enter(self, stage):
+        """
+        Called by metrics.timed when the current thread enters a stage
+        """
+        ident = threading.current_thread().ident
+        stack = self.stages[ident]
+        if stack:
+            # nested stage: its time is not counted twice
+            self.profiles[(stack[-1], ident)].disable()
+        stack.append(stage)
+        with self.lock:
+            profile = self.profiles.get((stage, ident))
+            if profile is None:
+                profile = self.profiles[(stage, ident)] = cProfile.Profile()
+        profile.enable()
+
+    def exit(self, stage):
+        """
+        Called by metrics.timed when the current thread leaves a stage
+        """
+        ident = threading.current_thread().ident
+        stack = self.stages[ident]
+        self.profiles[(stage, ident)].disable()
+        stack.pop()
+        if stack:
+            self.profiles[(stack[-1], ident)].enable()
+
+    def frameName(self, frame):
+        code = frame.f_code
+        return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def sampleLoop(self):
+        me = threading.current_thread().ident
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(self.frameName(frame))
+                    frame = frame.f_back
+                try:
+                    root = self.stages.get(ident, ())[-1]
+                except IndexError:
+                    if ident not in names:
+                        names = dict((t.ident, t.name) for t in threading.enumerate())
+                    root = names.get(ident, "thread")
+                frames.append(root)
+                self.samples[";".join(reversed(frames))] += 1
+
+    def stop(self):
+        """
+        Stop profiling and write the results
+        Returns nothing
+        """
+        metrics.profiler = None
+        self.stopped.set()
+        self.sampler.join()
+        elapsed = time.time() - self.started
+
+        bystage = defaultdict(list)
+        for (stage, ident), profile in self.profiles.items():
+            bystage[stage].append(profile)
+        with open(os.path.join(self.directory, "summary.txt"), 'w') as summary:
+            summary.write("profiled for %.1fs\n" % elapsed)
+            for stage, profiles in sorted(bystage.items()):
+                stats = pstats.Stats(profiles[0], stream=summary)
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(os.path.join(self.directory, stage + ".prof"))
+                summary.write("\n=== stage %s\n" % stage)
+                stats.sort_stats("cumulative").print_stats(15)
+
+        with open(os.path.join(self.directory, "stacks.collapsed"), 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write("%s %d\n" % (stack, count))
+
+        if self.memory:
+            self.writeMemory()
+        print "INFO profiling: results written to", self.directory
+
+    def writeMemory(self):
+        """
+        Write the top allocation sites and the peak RSS to memory.txt
+        """
+        with open(os.path.join(self.directory, "memory.txt"), 'w') as f:
+            # kilobytes on linux
+            f.write("peak RSS: %.1f MB\n" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+            if tracemalloc is None or not tracemalloc.is_tracing():
+                return
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            f.write("traced memory: %.1f MB, peak %.1f MB\n" % (current / 1048576.0, peak / 1048576.0))
+            f.write("\n=== top allocation sites\n")
+            for stat in snapshot.statistics("lineno")[:self.topAllocations]:
+                f.write("%s\n" % stat)
+            f.write("\n=== top allocation tracebacks\n")
+            for stat in snapshot.statistics("traceback")[:10]:
+                f.write("%s\n" % stat)
+                for line in stat.traceback.format():
+                    f.write("%s\n" % line)
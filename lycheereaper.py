@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import Queue
+import threading
+import traceback
+from lycheemetrics import metrics
+
+
+class FileReaper:
+
+    """
+    Delete the uploaded files (big file and thumbnails) of photos erased from lychee db
+    on a background thread, so that erasing a big album does not hold the db writer thread.
+    Urls are given once their erasure is committed (see LycheeDAO.onPhotosErased)
+    and deleted by batches of conf "reapBatchSize" photos (default 500)
+    """
+
+    def __init__(self, syncer):
+        """
+        Takes the LycheeSyncer as input, its deleteFiles is used
+        """
+        self.syncer = syncer
+        self.batchSize = syncer.conf.get("reapBatchSize", 500)
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="lychee-file-reaper")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def reap(self, urls):
+        """
+        Queue the deletion of the files of erased photos
+        Parameters:
+        - urls: a list of photo urls
+        Returns nothing
+        """
+        if urls:
+            self.queue.put(list(urls))
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            urls = self.queue.get()
+            if urls is None:
+                break
+            # take what is already queued along
+            while len(urls) < self.batchSize:
+                try:
+                    more = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if more is None:
+                    stopping = True
+                    break
+                urls.extend(more)
+            try:
+                removed = self.syncer.deleteFiles(urls)
+                metrics.inc("files_removed", removed)
+            except Exception:
+                print "FileReaper", Exception
+                traceback.print_exc()
+
+    def close(self):
+        """
+        Wait for every queued deletion
+        Returns nothing
+        """
+        self.queue.put(None)
+        self.thread.join()
@@ -6,11 +6,18 @@ import logging
 from watchdog.observers import Observer
 from galleryhandler import GalleryHandler
 import os
-import shutil
 import stat
 import traceback
 from lycheedao import LycheeDAO
+from lycheealbums import AlbumResolver
 from lycheemodel import LycheePhoto
+from lycheeutils import cloneFile, iterDirectory, removeFiles, walkTree, PLACEMENT_METHODS
+from lycheeimporter import LycheeImporter
+from lycheecatalog import LycheeCatalog
+from lycheemetrics import metrics, MetricsReporter
+from lycheereaper import FileReaper
+from lycheethumbs import ThumbnailRegenerator
+from lycheegc import GarbageCollector
 from PIL import Image
 
 
@@ -25,12 +32,14 @@ class LycheeSyncer:
     """
 
     conf = {}
+    dao = None
 
     def __init__(self, conf):
         """
         Takes a dictionnary of conf as input
         """
         self.conf = conf
+        self.albums = AlbumResolver(self)
 
     def getAlbumNameFromPath(self, path):
         """
@@ -42,6 +51,20 @@ class LycheeSyncer:
         # join the rest: no subfolders in lychee yet
         return "_".join(path).lower()
 
+    def getAlbumFromPath(self, dirpath):
+        """
+        build the album properties list of a source directory
+        Parameters:
+        - dirpath: a directory full path
+        Returns a dictionnary with the path, relpath and name of the album, its id is None
+        """
+        album = {}
+        album['path'] = dirpath
+        album['relpath'] = os.path.relpath(dirpath, self.conf['srcdir'])
+        album['name'] = self.getAlbumNameFromPath(album['relpath'])
+        album['id'] = None
+        return album
+
     def isAPhoto(self, file):
         """
         Determine if the filename passed is a photo or not based on the file extension
@@ -56,68 +79,163 @@ class LycheeSyncer:
         """
         Returns an albumid or None if album does not exists
         """
-        self.dao.albumExists(self, album_name)
+        return self.dao.albumExists(album_name)
 
     def createAlbum(self, album_name):
         """
         Creates an album
         Returns an albumid or None if album does not exists
         """
-        album = {}
-        if album_name != "":
-            album['name'] = album_name
-            album['id'] = self.dao.createAlbum(album)
-        return album['id']
+        if album_name == "":
+            return None
+        return self.dao.createAlbum({'name': album_name})
 
-    def thumbIt(self, res, photo, destinationpath, destfile):
+    def thumbIt(self, res, img, destinationpath, destfile):
         """
-        Create the thumbnail of a given photo
+        Create the thumbnail of a given image
         Parameters:
         - res: should be a set of h and v res (640, 480)
-        - photo: a valid LycheePhoto object
+        - img: an already opened (and oriented) PIL image, it is left untouched
         - destinationpath: a string the destination full path of the thumbnail (without filename)
         - destfile: the thumbnail filename
         Returns the fullpath of the thuumbnail
         """
-
-        if photo.width > photo.height:
-            delta = photo.width - photo.height
+        width, height = img.size
+        if width > height:
+            delta = width - height
             left = int(delta / 2)
             upper = 0
-            right = int(photo.height + left)
-            lower = int(photo.height)
+            right = int(height + left)
+            lower = int(height)
         else:
-            delta = photo.height - photo.width
+            delta = height - width
             left = 0
             upper = int(delta / 2)
-            right = int(photo.width)
-            lower = int(photo.width + upper)
+            right = int(width)
+            lower = int(width + upper)
 
         destimage = os.path.join(destinationpath, destfile)
-        img = Image.open(photo.srcfullpath)
-        img = img.crop((left, upper, right, lower))
-        img.thumbnail(res, Image.ANTIALIAS)
-        img.save(destimage, quality=99)
+        with metrics.timed("thumbnail"):
+            thumb = img.crop((left, upper, right, lower))
+            thumb.thumbnail(res, Image.ANTIALIAS)
+            # written aside then renamed: lychee never serves a half written thumbnail
+            tmpimage = os.path.join(destinationpath, ".tmp-" + destfile)
+            thumb.save(tmpimage, quality=self.conf.get("thumbQuality", 99))
+            os.rename(tmpimage, destimage)
         return destimage
 
+    # thumbnail sizes, the second one is the @2x thumbnail
+    thumbSizes = [(200, 200), (400, 400)]
+
+    def thumbnailNames(self, url):
+        """
+        Parameters:
+        - url: a photo url
+        Returns the file names of its thumbnails, in thumbSizes order
+        """
+        # insert @2x in big thumbnail file name
+        filesplit = os.path.splitext(url)
+        return [url, ''.join([filesplit[0], "@2x", filesplit[1]]).lower()]
+
     def makeThumbnail(self, photo):
         """
-        Make the 2 thumbnails needed by Lychee for a given photo
-        and store their path in the LycheePhoto object
+        Render every file Lychee needs for a given photo from a single decode of the source:
+        the 2 thumbnails and, if the exif orientation requires it, the rotated big file.
+        Thumbnails path are stored in the LycheePhoto object
         Parameters:
         - photo: a valid LycheePhoto object
         returns nothing
         """
+        if photo.duplicateof is not None:
+            # thumbnails of the original are shared
+            return
         # set  thumbnail size
-        sizes = [(200, 200), (400, 400)]
-        # insert @2x in big thumbnail file name
-        filesplit = os.path.splitext(photo.url)
-        destfiles = [photo.url, ''.join([filesplit[0], "@2x", filesplit[1]]).lower()]
+        sizes = self.thumbSizes
+        destfiles = self.thumbnailNames(photo.url)
         # compute destination path
         destpath = os.path.join(self.conf["lycheepath"], "uploads", "thumb")
+
+        # decode source once
+        with metrics.timed("decode"):
+            img = Image.open(photo.srcfullpath)
+            if self.conf.get('thumbMode', 'quality') == 'fast' and photo.exif.orientation not in self.orientations:
+                # the big file is a plain copy: let jpeg scaled DCT decode only what the biggest thumbnail needs
+                # (no-op for other formats)
+                img.draft(img.mode, max(sizes))
+            img.load()
+        # orientation is applied before thumbnailing
+        img = self.adjustRotation(photo, img)
+
         # make thumbnails
-        photo.thumbnailfullpath = self.thumbIt(sizes[0], photo, destpath, destfiles[0])
-        photo.thumbnailx2fullpath = self.thumbIt(sizes[1], photo, destpath, destfiles[1])
+        photo.thumbnailfullpath = self.thumbIt(sizes[0], img, destpath, destfiles[0])
+        photo.thumbnailx2fullpath = self.thumbIt(sizes[1], img, destpath, destfiles[1])
+
+        if photo.rotated:
+            # the big file can't be a plain copy of the source anymore
+            # AND LOOSE EXIF DATA
+            with metrics.timed("rotatedSave"):
+                img.save(photo.destfullpath, quality=99)
+
+    def regenerateThumbnail(self, url):
+        """
+        Render again the thumbnails of a photo already in lychee, from its big file
+        (which is always upright, see makeThumbnail)
+        Parameters:
+        - url: the photo url
+        Returns nothing, raises on error
+        """
+        destpath = os.path.join(self.conf["lycheepath"], "uploads", "thumb")
+        img = Image.open(os.path.join(self.conf["lycheepath"], "uploads", "big", url))
+        if self.conf.get('thumbMode', 'quality') == 'fast':
+            img.draft(img.mode, max(self.thumbSizes))
+        img.load()
+        for size, destfile in zip(self.thumbSizes, self.thumbnailNames(url)):
+            self.thumbIt(size, img, destpath, destfile)
+
+    def placeFile(self, photo):
+        """
+        copy (or link) a photo to the lychee uploads directory, adjust its permissions
+        and compute its checksum
+        Parameters:
+        - photo: a valid LycheePhoto object
+        Returns nothing, raises on error
+        """
+        if photo.duplicateof is not None:
+            # big file of the original is shared
+            return
+        # place photo, unless makeThumbnail already rendered a rotated one
+        # when it is copied, the checksum is computed in the same pass so that the source is read once
+        link = self.conf['link'] and not photo.rotated
+        method = None
+        if link:
+            os.symlink(photo.srcfullpath, photo.destfullpath)
+        elif not photo.rotated:
+            method, checksum = cloneFile(photo.srcfullpath, photo.destfullpath, self.placementMethods())
+            if checksum:
+                photo.checksum = checksum
+        if not photo.checksum:
+            photo.generateHash()
+        # adjust right (chmod/chown)
+        # a hard link is the source file itself, its owner is left untouched
+        if method != "hardlink":
+            os.lchown(photo.destfullpath, self.conf['uid'], self.conf['gid'])
+
+        if not(link) and method != "hardlink":
+            st = os.stat(photo.destfullpath)
+            os.chmod(photo.destfullpath, st.st_mode | stat.S_IRWXU | stat.S_IRWXG)
+        else:
+            st = os.stat(photo.srcfullpath)
+            os.chmod(photo.srcfullpath, st.st_mode | stat.S_IROTH)
+
+    def placementMethods(self):
+        """
+        Returns the file placement methods to try (see lycheeutils.cloneFile), from conf "placement":
+        "auto" (default) tries them all, from the cheapest, a method name tries it then falls back to a copy
+        """
+        placement = self.conf.get("placement", "auto")
+        if placement == "auto":
+            return PLACEMENT_METHODS
+        return (placement, "copy")
 
     def addFileToAlbum(self, photo):
         """
@@ -129,21 +247,11 @@ class LycheeSyncer:
         res = False
 
         try:
-            # copy photo
-            if self.conf['link']:
-                os.symlink(photo.srcfullpath, photo.destfullpath)
-            else:
-                shutil.copy(photo.srcfullpath, photo.destfullpath)
-            # adjust right (chmod/chown)
-            os.lchown(photo.destfullpath, self.conf['uid'], self.conf['gid'])
-
-            if not(self.conf['link']):
-                st = os.stat(photo.destfullpath)
-                os.chmod(photo.destfullpath, st.st_mode | stat.S_IRWXU | stat.S_IRWXG)
-            else:
-                st = os.stat(photo.srcfullpath)
-                os.chmod(photo.srcfullpath, st.st_mode | stat.S_IROTH)
-
+            if self.conf.get("dedup"):
+                photo.generateHash()
+                self.reuseUpload(photo)
+            with metrics.timed("place"):
+                self.placeFile(photo)
             res = self.dao.addFileToAlbum(photo)
 
         except Exception:
@@ -153,55 +261,139 @@ class LycheeSyncer:
 
         return res
 
+    def reuseUpload(self, photo):
+        """
+        Dedup mode (conf "dedup"): if a photo with the same checksum is already in lychee,
+        make this one share its url, so that its big file and thumbnails are reused
+        and only a new db row is inserted.
+        The photo must have its checksum computed. Runs where the dao is available
+        Parameters:
+        - photo: a valid LycheePhoto object
+        Returns True if the uploaded files of another photo are reused
+        """
+        photoid = self.dao.photoIdByChecksum(photo.checksum)
+        if photoid is None:
+            return False
+        url = self.dao.photosbyid[photoid][2]
+        photo.duplicateof = photoid
+        photo.url = url
+        photo.thumbUrl = url
+        photo.destfullpath = os.path.join(self.conf["lycheepath"], "uploads", "big", url)
+        if photo.exif.orientation in (5, 6, 7, 8):
+            # the shared big file was rendered upright (see adjustRotation)
+            photo.width, photo.height = photo.height, photo.width
+        if self.conf["verbose"]:
+            print "INFO duplicate of photo", photoid, "found:", photo.srcfullpath
+        return True
+
+    def importPhoto(self, photo):
+        """
+        Store a photo rendered by the import engine (thumbnails made, file placed) in the db
+        Runs in the db writer thread
+        Parameters:
+        - photo: a valid LycheePhoto object
+        Returns True if everything went ok
+        """
+        photo.albumid = self.albums.resolve(os.path.relpath(photo.originalpath, self.conf['srcdir']))
+        # recorded in the catalog once really inserted (see LycheeDAO.flush)
+        return self.dao.addFileToAlbum(photo)
+
+    def deletePhoto(self, album, photoname):
+        """
+        Remove a photo from lychee db, its files are deleted once it is erased (see FileReaper)
+        Runs in the db writer thread
+        Parameters:
+        - album: the album properties list, at least the name should be specified
+        - photoname: the photo original file name
+        Returns nothing
+        """
+        album['id'] = self.albums.resolve(album['relpath'], create=False)
+        if album['id'] is not None:
+            self.dao.erasePhoto(photoname, album['id'])
+            metrics.inc("photos_deleted")
+        # committed along with the queued erasures (see photosErased)
+        queued = self.dao.pendingerase or self.dao.erasedalbums
+        self.catalog.forget(os.path.join(album['path'], photoname), commit=not queued)
+
+    def photosErased(self, urls):
+        """
+        Called once queued erasures are committed in lychee db (see LycheeDAO.onPhotosErased):
+        the catalog removals are committed and the files of the erased photos deleted
+        Parameters:
+        - urls: the urls no photo uses anymore
+        Returns nothing
+        """
+        self.catalog.commit()
+        self.reaper.reap(urls)
+
+    def deleteAlbum(self, album):
+        """
+        Remove the albums of a deleted source directory and of its sub directories, and their photos, from lychee db
+        Their files are deleted once they are erased (see FileReaper)
+        Runs in the db writer thread
+        Parameters:
+        - album: the album properties list, at least the path should be specified
+        Returns nothing
+        """
+        prefix = os.path.join(album['path'], '')
+        dirpaths = set(d for d in self.catalog.listDirectories() if d.startswith(prefix))
+        dirpaths.add(album['path'])
+        for dirpath in dirpaths:
+            albumid = self.albums.resolve(os.path.relpath(dirpath, self.conf['srcdir']), create=False)
+            if albumid is not None:
+                metrics.inc("photos_deleted", self.dao.eraseAlbum({'id': albumid}))
+        self.catalog.forgetTree(album['path'])
+
     def deleteFiles(self, filelist):
         """
         Delete files in the Lychee file tree (uploads/big and uploads/thumbnails)
         Give it the file name and it will delete relatives files and thumbnails
+        Files still used by a photo in db are kept (see conf "dedup")
         Parameters:
         - filelist: a list of filenames
-        Returns nothing
+        Returns the number of files deleted
         """
-
+        removed = 0
         for url in filelist:
+            if self.dao is not None and self.dao.urlRefCount(url) > 0:
+                continue
             if self.isAPhoto(url):
-                thumbpath = os.path.join(self.conf["lycheepath"], "uploads", "thumb", url)
-                filesplit = os.path.splitext(url)
-                thumb2path = ''.join([filesplit[0], "@2x", filesplit[1]]).lower()
-                thumb2path = os.path.join(self.conf["lycheepath"], "uploads", "thumb", thumb2path)
-                bigpath = os.path.join(self.conf["lycheepath"], "uploads", "big", url)
-
-                os.remove(thumbpath)
-                os.remove(thumb2path)
-                os.remove(bigpath)
-
-    def rotatephoto(self, photo, rotation):
-        # rotate main photo
-        img = Image.open(photo.destfullpath)
-        img2 = img.rotate(rotation)
-        img2.save(photo.destfullpath, quality=99)
-        # rotate Thumbnails
-        img = Image.open(photo.thumbnailx2fullpath)
-        img2 = img.rotate(rotation)
-        img2.save(photo.thumbnailx2fullpath, quality=99)
-        img = Image.open(photo.thumbnailfullpath)
-        img2.rotate(rotation)
-        img2.save(photo.thumbnailfullpath, quality=99)
-
-    def adjustRotation(self, photo):
-        """
-        Rotates photos according to the exif orienttaion tag
-        Returns nothing
+                paths = [os.path.join(self.conf["lycheepath"], "uploads", "thumb", name)
+                         for name in self.thumbnailNames(url)]
+                paths.append(os.path.join(self.conf["lycheepath"], "uploads", "big", url))
+                removed += removeFiles(paths)
+        return removed
+
+    # exif orientation -> PIL transposition to get an upright image
+    orientations = {
+        2: [Image.FLIP_LEFT_RIGHT],
+        3: [Image.ROTATE_180],
+        4: [Image.FLIP_TOP_BOTTOM],
+        5: [Image.ROTATE_270, Image.FLIP_LEFT_RIGHT],
+        6: [Image.ROTATE_270],
+        7: [Image.ROTATE_90, Image.FLIP_LEFT_RIGHT],
+        8: [Image.ROTATE_90]
+    }
+
+    def adjustRotation(self, photo, img):
         """
-        if photo.exif.orientation not in (0, 1):
+        Rotates an in memory image according to the exif orienttaion tag of a photo
+        Width and height of the photo are updated accordingly
+        Parameters:
+        - photo: a valid LycheePhoto object
+        - img: the decoded PIL image of the photo
+        Returns the oriented image
+        """
+        if photo.exif.orientation in self.orientations:
             # There is somthing to do
-            if photo.exif.orientation == 6:
-                # rotate 90° clockwise
-                # AND LOOSE EXIF DATA
-                self.rotatephoto(photo, -90)
-            if photo.exif.orientation == 8:
-                # rotate 90° counterclockwise
-                # AND LOOSE EXIF DATA
-                self.rotatephoto(photo, 90)
+            with metrics.timed("adjustRotation"):
+                for method in self.orientations[photo.exif.orientation]:
+                    img = img.transpose(method)
+            w, h = img.size
+            photo.width = float(w)
+            photo.height = float(h)
+            photo.rotated = True
+        return img
 
     def reorderalbumids(self, albums):
 
@@ -222,8 +414,9 @@ class LycheeSyncer:
             newid = max + 1
 
         for a in sortedalbums:
-            self.dao.changeAlbumId(a['id'], newid)
+            self.dao.changeAlbumId(a['id'], newid, commit=False)
             newid = newid + 1
+        self.dao.commit()
 
     def updateAlbumsDate(self, albums):
         for a in albums:
@@ -231,31 +424,311 @@ class LycheeSyncer:
                 datelist = [photo.sysdate for photo in a['photos']]
                 if datelist is not None and len(datelist) > 0:
                     maxdate = max(datelist)
-                    self.dao.updateAlbumDate(a['id'], maxdate.replace(':', '-'))
+                    self.dao.updateAlbumDate(a['id'], maxdate.replace(':', '-'), commit=False)
             except Exception as e:
                 print "ERROR: updating album date for album:" + a['name'], e
+        self.dao.commit()
 
     def deleteAllFiles(self):
         """
-        Deletes every photo file in Lychee
+        Deletes every photo file in Lychee, big files and thumbnails, even those of no photo
+        Returns the number of files deleted
+        """
+        removed = 0
+        for directory in ("big", "thumb"):
+            photopath = os.path.join(self.conf["lycheepath"], "uploads", directory)
+            removed += removeFiles([f.path for f in iterDirectory(photopath) if self.isAPhoto(f.name)])
+        return removed
+
+    def movePhoto(self, src, dest):
+        """
+        Move or rename a photo in lychee without importing it again: its row gets its new
+        album and title, uploaded file and thumbnails are kept.
+        Photos unknown to lychee are imported.
+        Runs in the db writer thread
+        Parameters:
+        - src: the photo previous full path
+        - dest: the photo new full path
         Returns nothing
         """
-        filelist = []
-        photopath = os.path.join(self.conf["lycheepath"], "uploads", "big")
-        filelist = [f for f in os.listdir(photopath)]
-        self.deleteFiles(filelist)
+        srcalbum = self.getAlbumFromPath(os.path.dirname(src))
+        destalbum = self.getAlbumFromPath(os.path.dirname(dest))
+        srcname = os.path.basename(src)
+        destname = os.path.basename(dest)
+
+        photoid = self.dao.photoId(self.albums.resolve(srcalbum['relpath'], create=False), srcname)
+        if photoid is None:
+            self.catalog.forget(src)
+            destid = self.albums.resolve(destalbum['relpath'], create=False)
+            if self.dao.photoId(destid, destname) is not None:
+                # already moved along with its directory (see moveAlbums)
+                return
+            if not self.isSynced(dest):
+                self.importer.importPhoto(dest, destalbum)
+            return
+
+        destalbum['id'] = self.albums.resolve(destalbum['relpath'])
+        star = 1 if ('star' in destname) or ('cover' in destname) else 0
+        if self.dao.movePhoto(photoid, destalbum['id'], destname, star):
+            self.catalog.move(src, dest, destalbum['id'])
+            metrics.inc("photos_moved")
+
+    def moveAlbums(self, src, dest):
+        """
+        Move or rename a source directory in lychee without importing its photos again:
+        the albums of the directory and its sub directories are renamed, or merged
+        in existing albums with their new name
+        Runs in the db writer thread
+        Parameters:
+        - src: the directory previous full path
+        - dest: the directory new full path
+        Returns nothing
+        """
+        prefix = os.path.join(src, '')
+        for dirpath in self.catalog.listDirectories():
+            if dirpath != src and not dirpath.startswith(prefix):
+                continue
+            newdirpath = dest + dirpath[len(src):]
+            album = self.getAlbumFromPath(dirpath)
+            newalbum = self.getAlbumFromPath(newdirpath)
+            album['id'] = self.albums.resolve(album['relpath'], create=False)
+            if album['id'] is None:
+                # not in lychee anymore, its photos will be imported again when their move event comes
+                continue
+            newalbum['id'] = self.albums.resolve(newalbum['relpath'], create=False)
+            if newalbum['id'] is None:
+                self.dao.renameAlbum(album['id'], newalbum['name'])
+                newalbum['id'] = album['id']
+            elif newalbum['id'] != album['id']:
+                self.dao.mergeAlbum(album['id'], newalbum['id'])
+            self.catalog.moveDirectory(dirpath, newdirpath, newalbum['id'])
+
+    def isSynced(self, path):
+        """
+        Check in the catalog if a photo is already in lychee, or in the dao if its insert is still queued.
+        Only a change of size, mtime or inode counts, attribute changes (chmod, hard link) do not.
+        If it is but changed since, its removal from lychee is queued so it can be imported again
+        Parameters:
+        - path: the photo full path
+        Returns True if there is nothing to do
+        """
+        entry = self.catalog.lookup(path)
+        if entry is None:
+            # recorded in the catalog once inserted (see LycheeDAO.flush)
+            entry = self.queuedEntry(path)
+        elif long(entry['photoid']) not in self.dao.photosbyid:
+            # its photo is not in lychee anymore
+            entry = None
+        if entry is None:
+            return False
+        if self.catalog.isUpToDate(entry):
+            return True
+        album = self.getAlbumFromPath(os.path.dirname(path))
+        self.importer.write(self.deletePhoto, album, os.path.basename(path))
+        return False
+
+    def queuedEntry(self, path):
+        """
+        Look for a photo in the dao index, when it is not in the catalog yet
+        Parameters:
+        - path: the photo full path
+        Returns a catalog like entry (see LycheeCatalog.lookup) of the photo, or None if it is not in lychee
+        """
+        album = self.getAlbumFromPath(os.path.dirname(path))
+        photoid = self.dao.photoId(self.albums.resolve(album['relpath'], create=False), os.path.basename(path))
+        if photoid is None:
+            return None
+        # read from the watchdog thread while the writer thread queues inserts: a copy is iterated
+        for photo, values in list(self.dao.pendingphotos):
+            if long(photo.id) == photoid:
+                return {'path': path, 'size': photo.filesize, 'mtime': photo.mtime, 'inode': photo.inode}
+        # being recorded in the catalog (see LycheeDAO.flushInserts)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # gone, its deleted event will follow
+            return None
+        return {'path': path, 'size': st.st_size, 'mtime': st.st_mtime, 'inode': st.st_ino}
 
-    def sync(self):
+    def scan(self, photos):
+        """
+        Startup reconciliation between the source directory and lychee:
+        queue the import of new or changed photos and the removal of photos
+        deleted while lycheesync was not running. Photos found in lychee db
+        but not in the catalog are recorded as is.
+        Only catalog hits are stat-ed, the rest is decided from directory listings.
+        Parameters:
+        - photos: the (album, title, id, url, checksum) list of photos in lychee db
+        Returns the number of photos queued for import
+        """
+        indb = dict(((row[0], row[1]), row[2:]) for row in photos)
+        # catalog entries of photos dropped or deleted from lychee are not trusted
+        photoids = set(row[2] for row in photos)
+        knowndirs = self.catalog.listDirectories()
+        queued = 0
+        adopted = []
+        for album, files in self.walkAlbums():
+            dirpath = album['path']
+            knowndirs.discard(dirpath)
+            albumid = self.albums.resolve(album['relpath'], create=False)
+            synced = self.catalog.listDirectory(dirpath)
+
+            for f in files:
+                if not self.isAPhoto(f.name):
+                    continue
+                entry = synced.pop(f.name, None)
+                if entry is not None and long(entry['photoid']) not in photoids:
+                    entry = None
+                if entry is not None:
+                    if self.catalog.isUpToDate(entry, f.stat()):
+                        continue
+                    # changed since it was synced
+                    self.importer.write(self.deletePhoto, dict(album), f.name)
+                elif (albumid, f.name) in indb:
+                    # imported before the catalog existed
+                    st = f.stat()
+                    photoid, url, checksum = indb[(albumid, f.name)]
+                    adopted.append((f.path, st.st_size, st.st_mtime, st.st_ino, photoid, url, checksum, albumid))
+                    continue
+                if self.importer.importPhoto(f.path, dict(album)):
+                    queued += 1
+
+            # deleted while not watching
+            for name in synced:
+                self.importer.write(self.deletePhoto, dict(album), name)
+
+        # whole directories deleted while not watching
+        for dirpath in knowndirs:
+            album = self.getAlbumFromPath(dirpath)
+            for name in self.catalog.listDirectory(dirpath):
+                self.importer.write(self.deletePhoto, dict(album), name)
+
+        self.catalog.recordMany(adopted)
+        if self.conf["verbose"]:
+            print "INFO scan done:", queued, "photos queued,", len(adopted), "recorded in catalog"
+        return queued
+
+    def rebuildCatalog(self):
+        """
+        Rebuild the local catalog from the lychee db and the source directory
+        Returns nothing
+        """
+        self.dao = LycheeDAO(self.conf)
+        self.catalog = LycheeCatalog(self.conf)
+        try:
+            self.catalog.rebuild(self)
+        finally:
+            self.catalog.close()
+            self.dao.close()
+
+    def regenerateThumbnails(self):
+        """
+        Regenerate the thumbnails of every photo in lychee (see ThumbnailRegenerator)
+        Returns True if the job is complete
+        """
+        return ThumbnailRegenerator(self.conf).run()
+
+    def collectGarbage(self, dryrun=False):
+        """
+        Delete the uploaded files no photo in lychee uses (see GarbageCollector)
+        Parameters:
+        - dryrun: only report them
+        Returns True if the job is complete
+        """
+        return GarbageCollector(self.conf).run(dryrun)
+
+    def walkAlbums(self):
+        """
+        Walk the source directory, photos right in it belong to no album and are left out
+        Returns an iterator of (album properties list, file entries) for each sub directory
+        """
+        for dirpath, files in walkTree(self.conf["srcdir"]):
+            album = self.getAlbumFromPath(dirpath)
+            if album['relpath'] != '.':
+                yield album, files
+
+    def openSync(self):
+        """
+        Open what an import run needs: the import engine, the db, the catalog and the file reaper
+        Returns nothing
+        """
+        # worker processes are forked before the db connection is opened
+        self.importer = LycheeImporter(self)
         self.dao = LycheeDAO(self.conf)
+        self.catalog = LycheeCatalog(self.conf)
+        if self.conf["dropdb"]:
+            # lychee db was dropped along with the dao creation
+            self.catalog.clear()
+        self.dao.onPhotosInserted = self.catalog.record
+        self.reaper = FileReaper(self)
+        self.dao.onPhotosErased = self.photosErased
+        self.reaper.start()
+        # new ids come after the ones of a previous run
+        self.importer.ids.advance(self.dao.maxPhotoId())
+        self.importer.start()
+
+    def closeSync(self):
+        """
+        Wait for the pending imports and file deletions, then close what openSync opened
+        Returns nothing
+        """
+        self.importer.close()
+        self.reaper.close()
+        self.catalog.close()
+        self.dao.close()
+
+    def syncBatch(self, limit):
+        """
+        Import at most limit photos of the source directory not synced yet, then exit.
+        Nothing is watched nor removed from lychee (see sync)
+        Parameters:
+        - limit: the number of photos to import
+        Returns the number of photos imported
+        """
+        self.openSync()
+        queued = 0
+        try:
+            for album, files in self.walkAlbums():
+                for f in files:
+                    if queued >= limit:
+                        break
+                    if self.isAPhoto(f.name) and not self.isSynced(f.path):
+                        if self.importer.importPhoto(f.path, dict(album)):
+                            queued += 1
+                if queued >= limit:
+                    break
+        finally:
+            self.closeSync()
+        if self.conf["verbose"]:
+            print "INFO batch done:", queued, "photos imported"
+        return queued
+
+    def sync(self):
+        self.openSync()
+        # read before the writer thread starts updating the index
+        photos = self.dao.listPhotos()
 
         path = self.conf["srcdir"]
         event_handler = GalleryHandler(self)
+        event_handler.events.start()
+        self.importer.registerGauges()
+        metrics.gauge("watch_pending_events", lambda: len(event_handler.events))
+        metrics.gauge("watch_backlog_age_seconds", event_handler.events.backlogAge)
+        metrics.gauge("files_to_remove", self.reaper.queue.qsize)
+        reporter = MetricsReporter(self.conf)
+        reporter.start()
         observer = Observer()
         observer.schedule(event_handler, path, recursive=True)
         observer.start()
         try:
+            # catch up with what happened while we were not watching
+            self.scan(photos)
             while True:
                 time.sleep(1)
         except KeyboardInterrupt:
             observer.stop()
         observer.join()
+        event_handler.events.stop()
+        # let pending imports finish
+        self.closeSync()
+        reporter.stop()
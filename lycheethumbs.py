@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import time
+import traceback
+import lycheeimporter
+from lycheedao import LycheeDAO
+
+
+def initThumbWorker(conf):
+    """
+    Initialize a thumbnail worker process, with a low priority
+    so that the web server keeps the cpu it needs
+    """
+    lycheeimporter.initPoolWorker(conf)
+    os.nice(conf.get("thumbsNice", 10))
+
+
+def regenerateThumbnail(url):
+    """
+    Render again the thumbnails of a photo, runs in a worker process (or inline if workers is 0)
+    Parameters:
+    - url: the photo url
+    Returns (url, True) if it went ok
+    """
+    try:
+        lycheeimporter.worker_syncer.regenerateThumbnail(url)
+        return url, True
+    except Exception:
+        print "regenerateThumbnail", url
+        traceback.print_exc()
+        return url, False
+
+
+class ThumbnailRegenerator:
+
+    """
+    Regenerate the thumbnails of every photo in lychee db from its big file,
+    after a thumbQuality, thumbMode or thumbnail size change.
+    - work is spread on conf "workers" processes
+    - at most conf "thumbsRate" photos per second are done (0, the default, is unlimited)
+    - done photos are recorded in a checkpoint file (conf "thumbsCheckpoint", next to the catalog
+      by default), Ctrl+C stops the job and running it again resumes it
+    """
+
+    def __init__(self, conf):
+        """
+        Takes a dictionnary of conf as input
+        """
+        self.conf = conf
+        self.workers = self.conf.get("workers")
+        if self.workers is None:
+            self.workers = multiprocessing.cpu_count()
+        self.rate = self.conf.get("thumbsRate", 0)
+        self.checkpoint = self.conf.get("thumbsCheckpoint", self.conf["catalog"] + ".thumbs")
+        self.done = 0
+        self.failed = 0
+        self.total = 0
+        self.started = None
+        self.lastreport = 0
+
+    def listUrls(self):
+        """
+        Returns the sorted urls of the photos in lychee db, photos sharing files are done once
+        """
+        dao = LycheeDAO(self.conf)
+        try:
+            return sorted(set(dao.listAllPhoto()))
+        finally:
+            dao.close()
+
+    def loadCheckpoint(self):
+        """
+        Returns the set of urls already done by a previous run
+        """
+        if not os.path.exists(self.checkpoint):
+            return set()
+        with open(self.checkpoint) as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def throttle(self, urls):
+        """
+        Yield urls no faster than conf "thumbsRate" per second
+        """
+        start = time.time()
+        for i, url in enumerate(urls):
+            if self.rate:
+                delay = start + float(i) / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield url
+
+    def report(self, force=False):
+        """
+        Print the progress, every 5 seconds
+        """
+        now = time.time()
+        if not force and now - self.lastreport < 5:
+            return
+        self.lastreport = now
+        elapsed = max(now - self.started, 0.001)
+        speed = (self.done + self.failed) / elapsed
+        remaining = self.total - self.done - self.failed
+        eta = remaining / speed if speed else 0
+        print "INFO thumbnails: %d/%d done, %d failed, %.1f photos/s, %ds left" % (
+            self.done, self.total, self.failed, speed, eta)
+
+    def run(self):
+        """
+        Regenerate every thumbnail, not already done
+        Returns True if the job is complete
+        """
+        done = self.loadCheckpoint()
+        urls = [url for url in self.listUrls() if url not in done]
+        self.total = len(urls)
+        if done:
+            print "INFO thumbnails: resuming,", len(done), "photos already done"
+        self.started = time.time()
+        self.lastreport = self.started
+
+        pool = None
+        if self.workers > 0:
+            pool = multiprocessing.Pool(self.workers, initThumbWorker, (self.conf,))
+            results = pool.imap_unordered(regenerateThumbnail, self.throttle(urls))
+        else:
+            lycheeimporter.initWorker(self.conf)
+            results = (regenerateThumbnail(url) for url in self.throttle(urls))
+
+        complete = False
+        checkpoint = open(self.checkpoint, 'a')
+        try:
+            for i in xrange(self.total):
+                if pool:
+                    # with a timeout, so that Ctrl+C is not blocked while waiting
+                    while True:
+                        try:
+                            url, ok = results.next(1)
+                            break
+                        except multiprocessing.TimeoutError:
+                            self.report()
+                else:
+                    url, ok = results.next()
+                if ok:
+                    self.done += 1
+                    checkpoint.write(url + "\n")
+                    checkpoint.flush()
+                else:
+                    self.failed += 1
+                self.report()
+            complete = True
+        except KeyboardInterrupt:
+            print "INFO thumbnails: cancelled, run it again to resume"
+        finally:
+            if pool:
+                if complete:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+            checkpoint.close()
+
+        self.report(True)
+        if complete and not self.failed:
+            # next run starts over
+            os.remove(self.checkpoint)
+        return complete
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import hashlib
+import os
+import shutil
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    _copy_file_range = getattr(_libc, 'copy_file_range', None)
+    if _copy_file_range is not None:
+        _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_size_t, ctypes.c_uint]
+        _copy_file_range.restype = ctypes.c_ssize_t
+except (ImportError, OSError):
+    _copy_file_range = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # python 2 backport: pip install scandir
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# files are read by chunks of this size so that memory stays flat whatever the photo size
+CHUNK_SIZE = 1024 * 1024
+
+# linux ioctl sharing the data blocks of a file with another one (btrfs, xfs...)
+FICLONE = 0x40049409
+
+# file placement methods, tried in this order (see cloneFile)
+PLACEMENT_METHODS = ("reflink", "hardlink", "copyrange", "copy")
+
+# errors meaning a placement method is not supported here, the next one is tried
+UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+               errno.EPERM, errno.EMLINK)
+
+
+def fileChecksum(filepath):
+    """
+    Compute the sha1 checksum of a file, reading it by chunks
+    Parameters:
+    - filepath: the file full path
+    Returns the hexadecimal checksum
+    """
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            sha1.update(chunk)
+            chunk = f.read(CHUNK_SIZE)
+    return sha1.hexdigest()
+
+
+def copyFileWithChecksum(src, dst):
+    """
+    Copy a file (data and permission bits, like shutil.copy) and compute
+    its sha1 checksum in the same pass
+    Parameters:
+    - src: the source file full path
+    - dst: the destination file full path
+    Returns the hexadecimal checksum
+    """
+    sha1 = hashlib.sha1()
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            chunk = fsrc.read(CHUNK_SIZE)
+            while chunk:
+                sha1.update(chunk)
+                fdst.write(chunk)
+                chunk = fsrc.read(CHUNK_SIZE)
+    shutil.copymode(src, dst)
+    return sha1.hexdigest()
+
+
+def reflinkFile(src, dst):
+    """
+    Clone a file: the copy shares the data blocks of the source until one of them is modified
+    Parameters:
+    - src: the source file full path
+    - dst: the destination file full path, created
+    Raises an EnvironmentError if the filesystem can't do it
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "no fcntl")
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def hardlinkFile(src, dst):
+    """
+    Hard link a file, only if the destination is on the same filesystem
+    Parameters:
+    - src: the source file full path
+    - dst: the destination file full path, created
+    Raises an EnvironmentError if they are on different filesystems
+    """
+    if os.stat(src).st_dev != os.stat(os.path.dirname(dst)).st_dev:
+        raise OSError(errno.EXDEV, "not on the same filesystem")
+    os.link(src, dst)
+
+
+def copyRangeFile(src, dst):
+    """
+    Copy a file in the kernel (copy_file_range, or sendfile), data never goes through
+    python buffers and the filesystem may share blocks or copy server side
+    Parameters:
+    - src: the source file full path
+    - dst: the destination file full path, created
+    Raises an EnvironmentError if the kernel can't do it, or copied less than the file size
+    """
+    sendfile = getattr(os, 'sendfile', None)
+    if _copy_file_range is None and sendfile is None:
+        raise OSError(errno.ENOSYS, "no copy_file_range nor sendfile")
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            while remaining > 0:
+                count = min(remaining, 1 << 30)
+                if _copy_file_range is not None:
+                    done = _copy_file_range(fsrc.fileno(), None, fdst.fileno(), None, count, 0)
+                    if done < 0:
+                        err = ctypes.get_errno()
+                        raise OSError(err, os.strerror(err))
+                else:
+                    done = sendfile(fdst.fileno(), fsrc.fileno(), offset, count)
+                if done == 0:
+                    # the file shrank, or the filesystem can't do it: the next method (a buffered copy) is tried
+                    raise OSError(errno.EINVAL, "in kernel copy stopped %d bytes short" % remaining)
+                offset += done
+                remaining -= done
+    shutil.copymode(src, dst)
+
+
+def cloneFile(src, dst, methods=PLACEMENT_METHODS):
+    """
+    Place a copy of a file with the cheapest method available, in the given order:
+    - reflink: copy on write clone (btrfs, xfs), instant and no extra disk space
+    - hardlink: same file, if both paths are on the same filesystem
+    - copyrange: in kernel copy
+    - copy: buffered copy, the checksum is computed in the same pass
+    Parameters:
+    - src: the source file full path
+    - dst: the destination file full path, must not exist
+    - methods: the methods to try
+    Returns a (method, checksum) tuple, checksum is None unless the file was read (copy)
+    """
+    for method in methods:
+        if method == "copy":
+            return method, copyFileWithChecksum(src, dst)
+        try:
+            if method == "reflink":
+                reflinkFile(src, dst)
+            elif method == "hardlink":
+                hardlinkFile(src, dst)
+            elif method == "copyrange":
+                copyRangeFile(src, dst)
+            else:
+                raise ValueError("unknown placement method: " + method)
+            return method, None
+        except EnvironmentError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            # next method, starting from scratch
+            if os.path.lexists(dst):
+                os.remove(dst)
+    return "copy", copyFileWithChecksum(src, dst)
+
+
+def removeFiles(paths):
+    """
+    Delete files, missing ones are skipped and errors are reported, not raised
+    Parameters:
+    - paths: a list of file full paths
+    Returns the number of files deleted
+    """
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                print "removeFiles", path, e
+    return removed
+
+
+class ListdirEntry:
+
+    """
+    Minimal os.DirEntry replacement, used when scandir is not available
+    """
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def listDirectory(dirpath):
+    """
+    List a directory, with scandir if available: file types come with the
+    directory listing and files are only stat-ed if needed
+    Parameters:
+    - dirpath: a directory full path
+    Returns a list of DirEntry like objects (name, path, is_dir(), stat())
+    """
+    if scandir is not None:
+        return list(scandir(dirpath))
+    return [ListdirEntry(dirpath, name) for name in os.listdir(dirpath)]
+
+
+def iterDirectory(dirpath):
+    """
+    Iterate over a directory, like listDirectory, entries are read as they go with scandir
+    so that huge directories are not held in memory
+    Parameters:
+    - dirpath: a directory full path
+    Yields DirEntry like objects (name, path, is_dir(), stat())
+    """
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            yield entry
+    else:
+        for name in os.listdir(dirpath):
+            yield ListdirEntry(dirpath, name)
+
+
+def walkTree(top):
+    """
+    Walk a directory tree, top-down, without following symlinks to directories
+    Parameters:
+    - top: the root directory full path
+    Yields a (dirpath, files) tuple per directory, files being a list of DirEntry like objects
+    """
+    dirs = [top]
+    while dirs:
+        dirpath = dirs.pop()
+        try:
+            entries = listDirectory(dirpath)
+        except OSError:
+            continue
+        files = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            else:
+                files.append(entry)
+        yield dirpath, files
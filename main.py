@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from lycheesyncer import LycheeSyncer
+from lycheeprofile import LycheeProfiler
 from update_scripts import inf_to_lychee_2_6_2
 import argparse
 import os
@@ -15,8 +16,25 @@ def main(conf):
     """ just call to LycheeSyncer """
 
     # DELEGATE WORK TO LYCHEESYNCER
+    profiler = None
+    if conf["profiledir"]:
+        profiler = LycheeProfiler(conf)
+        profiler.start()
     s = LycheeSyncer(conf)
-    s.sync()
+    try:
+        if conf["rebuildcatalog"]:
+            s.rebuildCatalog()
+        elif conf["regeneratethumbs"]:
+            s.regenerateThumbnails()
+        elif conf["gc"]:
+            s.collectGarbage(conf["dryrun"])
+        elif conf["batch"]:
+            s.syncBatch(conf["batch"])
+        else:
+            s.sync()
+    finally:
+        if profiler:
+            profiler.stop()
 
 
 def show_args():
@@ -30,13 +48,23 @@ def show_args():
     print "* conf:" + args.conf
     print "* sort_by_name:" + str(conf_data['sort'])
     print "* link:" + str(conf_data['link'])
+    print "* rebuildcatalog:" + str(conf_data['rebuildcatalog'])
+    print "* regeneratethumbs:" + str(conf_data['regeneratethumbs'])
+    print "* gc:" + str(conf_data['gc'])
+    print "* dryrun:" + str(conf_data['dryrun'])
+    print "* batch:" + str(conf_data['batch'])
+    print "* profiledir:" + str(conf_data['profiledir'])
+    print "* profilememory:" + str(conf_data['profilememory'])
     print "Program Launched with conf:"
     print "* dbHost:" + conf_data['dbHost']
     print "* db:" + conf_data['db']
     print "* dbUser:" + conf_data['dbUser']
     print "* dbPassword:" + conf_data['dbPassword']
     print "* thumbQuality:" + str(conf_data['thumbQuality'])
+    print "* thumbMode:" + str(conf_data.get('thumbMode', 'quality'))
     print "* publicAlbum:" + str(conf_data['publicAlbum'])
+    print "* workers:" + str(conf_data.get('workers'))
+    print "* catalog:" + conf_data['catalog']
     print "Other conf elements:"
     print "* user:" + str(conf_data["user"])
     print "* group:" + str(conf_data["group"])
@@ -61,7 +89,14 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose', help='increase output verbosity', action='store_true')
     parser.add_argument('-s', '--sort_album_by_name', help='sort album display by name', action='store_true')
     parser.add_argument('-l', '--link', help='do not copy photos to lychee uploads directory, just create a symlink', action='store_true')
+    parser.add_argument('--rebuild-catalog', dest='rebuildcatalog', help='rebuild the local catalog of synced photos from lychee db and exit', action='store_true')
+    parser.add_argument('--regenerate-thumbnails', dest='regeneratethumbs', help='render again the thumbnails of every photo in lychee db and exit (Ctrl+C to stop, run again to resume)', action='store_true')
+    parser.add_argument('--gc', dest='gc', help='delete the files of lychee uploads no photo of lychee db uses and exit (Ctrl+C to stop, run again to resume)', action='store_true')
     parser.add_argument('-u', '--updatedb26', action='store_const', dest='updatedb_to_version_2_6_2', const='2.6.2', help='Update lycheesync added data in lychee db to the lychee 2.6.2 required values')
+    parser.add_argument('--dry-run', dest='dryrun', help='with -u, only report what would be updated and an estimate of the time it would take, with --gc, only report the files to delete', action='store_true')
+    parser.add_argument('--batch', type=int, metavar='N', help='import at most N photos not synced yet and exit, nothing is watched', default=0)
+    parser.add_argument('--profile', dest='profiledir', metavar='DIR', help='profile the run (per stage cProfile stats and flame graph stacks), results are written to DIR')
+    parser.add_argument('--profile-memory', dest='profilememory', help='with --profile, also report the top memory allocation sites (needs tracemalloc)', action='store_true')
     args = parser.parse_args()
     shouldquit = False
 
@@ -73,6 +108,10 @@ if __name__ == '__main__':
         shouldquit = True
         print "lychee install path may be wrong:" + args.lycheepath
 
+    if args.profilememory and not args.profiledir:
+        shouldquit = True
+        print "--profile-memory needs --profile DIR"
+
     if not os.path.exists(args.conf):
         shouldquit = True
         print "configuration file  does not exist:" + args.conf
@@ -96,12 +135,22 @@ if __name__ == '__main__':
     conf_data["replace"] = args.replace
     conf_data["verbose"] = args.verbose
     conf_data["updatedb"] = args.updatedb_to_version_2_6_2
+    conf_data["dryrun"] = args.dryrun
     conf_data["user"] = None
     conf_data["group"] = None
     conf_data["uid"] = None
     conf_data["gid"] = None
     conf_data["sort"] =  args.sort_album_by_name
     conf_data["link"] =  args.link
+    conf_data["rebuildcatalog"] = args.rebuildcatalog
+    conf_data["regeneratethumbs"] = args.regeneratethumbs
+    conf_data["gc"] = args.gc
+    conf_data["batch"] = args.batch
+    conf_data["profiledir"] = args.profiledir
+    conf_data["profilememory"] = args.profilememory
+    if not conf_data.get("catalog"):
+        # the catalog lives next to the configuration file by default
+        conf_data["catalog"] = os.path.join(os.path.dirname(os.path.abspath(args.conf)), "lycheesync.catalog")
     if conf_data["dropdb"]:
         conf_data["sort"] = True
 
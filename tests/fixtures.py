@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Test fixtures:
+- a sqlite stand-in of the lychee mysql db, to run LycheeDAO without a mysql server
+- a conf dictionnary and small photo files in a temporary lychee tree
+"""
+
+import os
+import sqlite3
+from PIL import Image
+from lycheedao import ConnectionPool
+from lycheemodel import LycheePhoto
+
+# column types of lychee_photos, like in lychee: album is a string column, its values come back as strings
+PHOTO_COLUMN_TYPES = {"id": "bigint primary key", "album": "varchar(30)"}
+
+
+class SqliteCursor:
+
+    """
+    MySQLdb cursor look alike over sqlite
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=None):
+        self.cursor.execute(query.replace("%s", "?"), tuple(params or ()))
+        return self.cursor.rowcount
+
+    def executemany(self, query, params):
+        self.cursor.executemany(query.replace("%s", "?"), [tuple(p) for p in params])
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+class SqliteConnection:
+
+    """
+    MySQLdb connection look alike over sqlite, with the lychee tables
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        # mysql named locks used by LycheeDAO.createAlbum, the stand-in is used by a single process
+        self.db.create_function("GET_LOCK", 2, lambda name, timeout: 1)
+        self.db.create_function("RELEASE_LOCK", 1, lambda name: 1)
+        self.db.execute("create table if not exists lychee_albums (id integer primary key autoincrement, " +
+                        "title text, description text, sysstamp integer, public integer, visible integer, " +
+                        "downloadable integer, password text)")
+        self.db.execute("create table if not exists lychee_photos (" +
+                        ", ".join((c + " " + PHOTO_COLUMN_TYPES.get(c, "")).strip() for c in LycheePhoto.columns) +
+                        ")")
+        # mysql's one row table, used by LycheeDAO.createAlbum
+        self.db.execute("create table if not exists dual (x integer)")
+        self.db.execute("insert into dual select 1 where not exists (select 1 from dual)")
+        self.db.commit()
+
+    def cursor(self):
+        return SqliteCursor(self.db.cursor())
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def ping(self):
+        pass
+
+    def close(self):
+        self.db.close()
+
+
+class SqlitePool(ConnectionPool):
+
+    """
+    ConnectionPool of SqliteConnection, give it to LycheeDAO
+    """
+
+    def __init__(self, conf, path, size=None):
+        ConnectionPool.__init__(self, conf, size)
+        self.path = path
+
+    def connect(self):
+        return SqliteConnection(self.path)
+
+
+def makeConf(root):
+    """
+    Returns a conf dictionnary for a lychee tree and a source directory in root
+    """
+    conf = {"srcdir": os.path.join(root, "src"), "lycheepath": os.path.join(root, "lychee"),
+            "catalog": os.path.join(root, "catalog.db"), "dropdb": False, "verbose": False, "link": False,
+            "publicAlbum": 0, "uid": os.getuid(), "gid": os.getgid(),
+            "workers": 0, "dbBatchSize": 100, "dbBatchDelay": 2, "placement": "copy"}
+    for directory in ("big", "thumb"):
+        os.makedirs(os.path.join(conf["lycheepath"], "uploads", directory))
+    os.makedirs(conf["srcdir"])
+    return conf
+
+
+def makePhoto(path, color=(128, 64, 32), size=(64, 48)):
+    """
+    Write a small jpeg photo, its directory is created if needed
+    Returns its path
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    Image.new('RGB', size, color).save(path, "JPEG")
+    return path
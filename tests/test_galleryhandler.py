@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from galleryhandler import EventQueue
+from tests.fixtures import makePhoto
+
+
+class RecordingHandler:
+
+    """
+    GalleryHandler look alike, records the dispatched actions
+    """
+
+    def __init__(self):
+        self.actions = []
+
+    def importFile(self, path):
+        self.actions.append(('import', path))
+
+    def deleteFile(self, path):
+        self.actions.append(('delete', path))
+
+    def deleteDirectory(self, path):
+        self.actions.append(('deletedir', path))
+
+    def moveFile(self, src, dest):
+        self.actions.append(('move', src, dest))
+
+    def moveDirectory(self, src, dest):
+        self.actions.append(('movedir', src, dest))
+
+
+class MergeTest(unittest.TestCase):
+
+    """
+    Net action of each event chain (see EventQueue.merge and pushMove)
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.handler = RecordingHandler()
+        self.events = EventQueue(self.handler, 0)
+        self.a = makePhoto(os.path.join(self.tmp, "a.jpg"))
+        self.b = os.path.join(self.tmp, "b.jpg")
+        self.c = os.path.join(self.tmp, "c.jpg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def actions(self):
+        return dict((path, (entry['action'], entry['src'])) for path, entry in self.events.pending.items())
+
+    def testCreatedModified(self):
+        self.events.push('created', self.a)
+        self.events.push('modified', self.a)
+        self.assertEqual(self.actions(), {self.a: ('created', None)})
+
+    def testCreatedDeleted(self):
+        self.events.push('created', self.a)
+        self.events.push('deleted', self.a)
+        self.assertEqual(self.actions(), {})
+
+    def testModifiedDeleted(self):
+        self.events.push('modified', self.a)
+        self.events.push('deleted', self.a)
+        self.assertEqual(self.actions(), {self.a: ('deleted', None)})
+
+    def testDeletedCreated(self):
+        self.events.push('deleted', self.a)
+        self.events.push('created', self.a)
+        self.assertEqual(self.actions(), {self.a: ('modified', None)})
+
+    def testMovedModified(self):
+        self.events.pushMove(self.b, self.a)
+        self.events.push('modified', self.a)
+        self.assertEqual(self.actions(), {self.a: ('created', None), self.b: ('deleted', None)})
+
+    def testMovedDeleted(self):
+        self.events.pushMove(self.a, self.b)
+        self.events.push('deleted', self.b)
+        self.assertEqual(self.actions(), {self.a: ('deleted', None)})
+
+    def testCreatedMoved(self):
+        self.events.push('created', self.a)
+        self.events.pushMove(self.a, self.b)
+        self.assertEqual(self.actions(), {self.b: ('created', None)})
+
+    def testMovedTwice(self):
+        self.events.pushMove(self.a, self.b)
+        self.events.pushMove(self.b, self.c)
+        self.assertEqual(self.actions(), {self.c: ('moved', self.a)})
+
+    def testMovedBack(self):
+        self.events.pushMove(self.a, self.b)
+        self.events.pushMove(self.b, self.a)
+        self.assertEqual(self.actions(), {})
+
+    def testModifiedMoved(self):
+        self.events.push('modified', self.a)
+        self.events.pushMove(self.a, self.b)
+        self.assertEqual(self.actions(), {self.a: ('deleted', None), self.b: ('created', None)})
+
+    def testDirectoryDeleted(self):
+        # the directory deletion covers its content, a photo moved in from outside is deleted at its source
+        directory = os.path.join(self.tmp, "dir")
+        self.events.push('created', os.path.join(directory, "x.jpg"))
+        self.events.pushMove(self.c, os.path.join(directory, "y.jpg"))
+        self.events.push('deleted', directory, True)
+        self.assertEqual(self.actions(), {directory: ('deleted', None), self.c: ('deleted', None)})
+
+    def testDirectoryMoved(self):
+        self.events.pushMove(os.path.join(self.tmp, "dir"), os.path.join(self.tmp, "new"), True)
+        self.assertEqual(self.actions(), {os.path.join(self.tmp, "new"): ('moved', os.path.join(self.tmp, "dir"))})
+
+
+class DispatchTest(unittest.TestCase):
+
+    """
+    Settled actions reach the handler (see EventQueue.dispatchDue)
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.handler = RecordingHandler()
+        self.events = EventQueue(self.handler, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testDispatch(self):
+        a = makePhoto(os.path.join(self.tmp, "a.jpg"))
+        b = os.path.join(self.tmp, "b.jpg")
+        self.events.push('created', a)
+        self.events.pushMove(os.path.join(self.tmp, "c.jpg"), b)
+        self.events.push('deleted', os.path.join(self.tmp, "dir"), True)
+        self.events.dispatchDue()
+        self.assertEqual(sorted(self.handler.actions),
+                         sorted([('import', a), ('move', os.path.join(self.tmp, "c.jpg"), b),
+                                 ('deletedir', os.path.join(self.tmp, "dir"))]))
+        self.assertEqual(len(self.events), 0)
+
+    def testFileGoneBeforeSettled(self):
+        a = makePhoto(os.path.join(self.tmp, "a.jpg"))
+        self.events.push('created', a)
+        os.remove(a)
+        self.events.dispatchDue()
+        self.assertEqual(self.handler.actions, [])
+
+    def testFileStillWritten(self):
+        a = makePhoto(os.path.join(self.tmp, "a.jpg"))
+        self.events.push('created', a)
+        makePhoto(a, size=(128, 96))
+        self.events.dispatchDue()
+        self.assertEqual(self.handler.actions, [])
+        self.events.dispatchDue()
+        self.assertEqual(self.handler.actions, [('import', a)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from lycheecatalog import LycheeCatalog
+from tests.fixtures import makeConf, makePhoto
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conf = makeConf(self.tmp)
+        self.catalog = LycheeCatalog(self.conf)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmp)
+
+    def record(self, path, photoid, albumid=1):
+        st = os.stat(path)
+        self.catalog.recordMany([(path, st.st_size, st.st_mtime, st.st_ino, photoid, "url", "checksum", albumid)])
+
+    def testUpToDate(self):
+        path = makePhoto(os.path.join(self.conf["srcdir"], "a", "p.jpg"))
+        self.assertFalse(self.catalog.isSynced(path))
+        self.record(path, "1")
+        self.assertTrue(self.catalog.isSynced(path))
+        self.assertEqual(self.catalog.lookup(path)["photoid"], "1")
+        makePhoto(path, size=(128, 96))
+        self.assertFalse(self.catalog.isSynced(path))
+        os.remove(path)
+        self.assertFalse(self.catalog.isSynced(path))
+
+    def testListDirectory(self):
+        paths = [makePhoto(os.path.join(self.conf["srcdir"], "a", name)) for name in ("p.jpg", "q.jpg")]
+        other = makePhoto(os.path.join(self.conf["srcdir"], "a", "sub", "r.jpg"))
+        for i, path in enumerate(paths + [other]):
+            self.record(path, str(i))
+        self.assertEqual(sorted(self.catalog.listDirectory(os.path.dirname(paths[0]))), ["p.jpg", "q.jpg"])
+        self.assertEqual(self.catalog.listDirectories(), set([os.path.dirname(paths[0]), os.path.dirname(other)]))
+
+    def testMoveDirectory(self):
+        # paths are byte strings, sqlite counts characters
+        src = os.path.join(self.conf["srcdir"], "\xc3\xa9t\xc3\xa9")
+        dest = os.path.join(self.conf["srcdir"], "summer")
+        path = makePhoto(os.path.join(src, "p.jpg"))
+        self.record(path, "1")
+        self.catalog.moveDirectory(src, dest, 2)
+        self.assertIsNone(self.catalog.lookup(path))
+        entry = self.catalog.lookup(os.path.join(dest, "p.jpg"))
+        self.assertEqual(entry["albumid"], 2)
+
+    def testForgetTree(self):
+        tree = os.path.join(self.conf["srcdir"], "\xc3\xa9t\xc3\xa9")
+        inside = [makePhoto(os.path.join(tree, "p.jpg")), makePhoto(os.path.join(tree, "sub", "q.jpg"))]
+        sibling = makePhoto(os.path.join(tree + "x", "r.jpg"))
+        for i, path in enumerate(inside + [sibling]):
+            self.record(path, str(i))
+        self.catalog.forgetTree(tree)
+        for path in inside:
+            self.assertIsNone(self.catalog.lookup(path))
+        self.assertIsNotNone(self.catalog.lookup(sibling))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from lycheecatalog import LycheeCatalog
+from lycheedao import LycheeDAO
+from lycheemodel import LycheePhoto
+from tests.fixtures import makeConf, makePhoto, SqlitePool
+
+
+class DAOTestCase(unittest.TestCase):
+
+    """
+    A LycheeDAO over the sqlite stand-in, with an album of three photo files not imported yet
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conf = makeConf(self.tmp)
+        albumpath = os.path.join(self.conf["srcdir"], "album")
+        self.paths = [makePhoto(os.path.join(albumpath, "photo%d.jpg" % i), (i * 60, 0, 0)) for i in range(3)]
+        self.pool = SqlitePool(self.conf, os.path.join(self.tmp, "lychee.db"))
+        self.dao = LycheeDAO(self.conf, self.pool)
+        self.album = {'path': albumpath, 'name': "album"}
+        self.dao.createAlbum(self.album)
+
+    def tearDown(self):
+        self.dao.close()
+        shutil.rmtree(self.tmp)
+
+    def addPhoto(self, path):
+        photo = LycheePhoto(self.conf, os.path.basename(path), self.album)
+        photo.generateHash()
+        self.dao.addFileToAlbum(photo)
+        return photo
+
+    def photoIds(self):
+        cur = self.dao.db.cursor()
+        cur.execute("select id from lychee_photos")
+        return [long(row[0]) for row in cur.fetchall()]
+
+
+class EraseTest(DAOTestCase):
+
+    """
+    Queued erasures of photos whose insert is still queued (see LycheeDAO.flushErased)
+    """
+
+    def testEraseDueBeforeInsert(self):
+        # an older erasure is due while the photo created then deleted since still waits for its insert
+        old = self.addPhoto(self.paths[0])
+        self.addPhoto(self.paths[1])
+        self.dao.flush()
+        self.dao.erasePhoto(old.originalname, old.albumid)
+        self.dao.erasesince -= self.conf["dbBatchDelay"]
+        photo = self.addPhoto(self.paths[2])
+        self.dao.erasePhoto(photo.originalname, photo.albumid)
+        self.dao.flushIfDue()
+        self.dao.flush()
+        self.assertNotIn(long(photo.id), self.photoIds())
+        self.assertNotIn(long(old.id), self.photoIds())
+        self.assertEqual(len(self.photoIds()), 1)
+
+    def testEraseBatchBeforeInsert(self):
+        # erasures reach conf "dbBatchSize" first
+        self.conf["dbBatchSize"] = 2
+        old = self.addPhoto(self.paths[0])
+        self.addPhoto(self.paths[1])
+        photo = self.addPhoto(self.paths[2])
+        self.dao.queueErase([long(photo.id), long(old.id)])
+        self.dao.flush()
+        self.assertEqual(len(self.photoIds()), 1)
+        self.assertNotIn(long(photo.id), self.dao.photosbyid)
+
+
+class CatalogConsistencyTest(DAOTestCase):
+
+    """
+    The catalog records photos once they are in db (see LycheeDAO.onPhotosInserted)
+    """
+
+    def setUp(self):
+        DAOTestCase.setUp(self)
+        self.catalog = LycheeCatalog(self.conf)
+        self.dao.onPhotosInserted = self.catalog.record
+
+    def tearDown(self):
+        DAOTestCase.tearDown(self)
+        self.catalog.close()
+
+    def testRecordedOnceInserted(self):
+        photo = self.addPhoto(self.paths[0])
+        self.assertIsNone(self.catalog.lookup(self.paths[0]))
+        self.dao.flush()
+        entry = self.catalog.lookup(self.paths[0])
+        self.assertEqual(long(entry["photoid"]), long(photo.id))
+        self.assertIn(long(entry["photoid"]), self.photoIds())
+        self.assertTrue(self.catalog.isSynced(self.paths[0]))
+
+
+class ReloadedIndexTest(DAOTestCase):
+
+    """
+    Photos inserted by a previous run are found by album id and title,
+    lychee_photos.album is a string column (see LycheeDAO.indexPhoto)
+    """
+
+    def setUp(self):
+        DAOTestCase.setUp(self)
+        self.photos = [self.addPhoto(path) for path in self.paths]
+        self.dao.close()
+        self.dao = LycheeDAO(self.conf, self.pool)
+
+    def testLookup(self):
+        for photo in self.photos:
+            self.assertEqual(self.dao.photoslist.get((self.album['id'], photo.originalname)), long(photo.id))
+            self.assertTrue(self.dao.photoExists(photo))
+        self.assertEqual(sorted(self.dao.listAlbumPhotoIds(self.album['id'])),
+                         sorted(long(p.id) for p in self.photos))
+
+    def testErasePhoto(self):
+        self.dao.erasePhoto(self.photos[0].originalname, self.album['id'])
+        self.dao.flush()
+        self.assertEqual(sorted(self.photoIds()), sorted(long(p.id) for p in self.photos[1:]))
+
+    def testEraseAlbum(self):
+        self.assertEqual(self.dao.eraseAlbum({'id': self.album['id']}), 3)
+        self.dao.flush()
+        self.assertEqual(self.photoIds(), [])
+        self.assertNotIn(self.album['name'], self.dao.albumslist)
+
+
+if __name__ == '__main__':
+    unittest.main()
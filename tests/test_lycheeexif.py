@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from lycheeexif import parseTiff, readHeader
+
+
+def makeTiff(make, orientation):
+    """
+    A little endian tiff IFD0 with Make and Orientation tags
+    """
+    entries = struct.pack("<HHLL", 0x0112, 3, 1, orientation)
+    # the make string does not fit in the entry, it follows the IFD
+    entries += struct.pack("<HHLL", 0x010F, 2, len(make) + 1, 8 + 2 + 2 * 12 + 4)
+    return "II*\x00" + struct.pack("<L", 8) + struct.pack("<H", 2) + entries + struct.pack("<L", 0) + make + "\x00"
+
+
+def segment(marker, data):
+    return "\xff" + chr(marker) + struct.pack(">H", len(data) + 2) + data
+
+
+class ExifTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "photo.jpg")
+        self.exif = segment(0xE1, "Exif\x00\x00" + makeTiff("Canon", 6))
+        # 8 bits, 480x640, 3 components
+        self.sof = segment(0xC0, struct.pack(">BHHB", 8, 480, 640, 3) + "\x01\x22\x00" * 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def testHeader(self):
+        self.write("\xff\xd8" + self.exif + self.sof + "\xff\xda")
+        self.assertEqual(readHeader(self.path), (640, 480, {"make": "Canon", "orientation": 6}))
+
+    def testTruncatedTiff(self):
+        tiff = makeTiff("Canon", 6)
+        # the make string is cut: the tags before it are kept
+        self.assertEqual(parseTiff(tiff[:-4]), {"orientation": 6})
+        # the second entry is cut in the middle of its count
+        self.assertEqual(parseTiff(tiff[:8 + 2 + 12 + 6]), {"orientation": 6})
+        self.assertEqual(parseTiff(tiff[:6]), {})
+
+    def testTruncatedSof(self):
+        # the file ends in the start of frame segment
+        self.write("\xff\xd8" + self.exif + self.sof[:7])
+        self.assertEqual(readHeader(self.path), (None, None, {"make": "Canon", "orientation": 6}))
+
+    def testTruncatedApp1(self):
+        # the file ends in the exif segment
+        self.write("\xff\xd8" + self.exif[:30])
+        self.assertEqual(readHeader(self.path), (None, None, {}))
+
+    def testTruncatedPng(self):
+        self.write("\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR\x00\x00")
+        self.assertEqual(readHeader(self.path), (None, None, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
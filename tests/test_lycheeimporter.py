@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import unittest
+from lycheemetrics import metrics
+from tests.test_lycheesyncer import SyncerTestCase
+
+
+def unpicklable():
+    """
+    A job whose result can't be sent back to the main process
+    """
+    return lambda: None
+
+
+def crash():
+    """
+    A job killing its worker process
+    """
+    os._exit(1)
+
+
+class CloseTest(SyncerTestCase):
+
+    """
+    Closing the import engine while some pool jobs will never call back (see LycheeImporter.checkJobs)
+    """
+
+    def setUp(self):
+        SyncerTestCase.setUp(self)
+        self.conf["workers"] = 1
+        self.conf["importTimeout"] = 1
+        self.syncer.openSync()
+        self.importer = self.syncer.importer
+
+    def tearDown(self):
+        self.syncer.reaper.close()
+        self.syncer.catalog.close()
+        self.syncer.dao.close()
+        SyncerTestCase.tearDown(self)
+
+    def submit(self, func, srcpath):
+        self.importer.pending.add(srcpath)
+        self.importer.submit(func, (), lambda photo: self.importer.write(self.importer.insertPhoto, srcpath, photo))
+
+    def close(self):
+        """
+        Returns True if the import engine closed in time
+        """
+        thread = threading.Thread(target=self.importer.close)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        return not thread.is_alive()
+
+    def testResultFailed(self):
+        errors = metrics.counters.get("import_errors", 0)
+        self.submit(unpicklable, "a.jpg")
+        self.assertTrue(self.close())
+        self.assertEqual(self.importer.pending, set())
+        self.assertEqual(metrics.counters.get("import_errors", 0), errors + 1)
+
+    def testWorkerDied(self):
+        self.submit(crash, "a.jpg")
+        self.assertTrue(self.close())
+        self.assertEqual(self.importer.pending, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+import lycheesyncer
+from galleryhandler import GalleryHandler
+from lycheedao import LycheeDAO
+from lycheesyncer import LycheeSyncer
+from tests.fixtures import makeConf, makePhoto, SqlitePool
+
+
+class SyncerTestCase(unittest.TestCase):
+
+    """
+    A LycheeSyncer whose LycheeDAO runs over the sqlite stand-in, imports are done in the writer thread
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conf = makeConf(self.tmp)
+        self.pool = SqlitePool(self.conf, os.path.join(self.tmp, "lychee.db"))
+        self.LycheeDAO = lycheesyncer.LycheeDAO
+        lycheesyncer.LycheeDAO = lambda conf: LycheeDAO(conf, self.pool)
+        self.syncer = LycheeSyncer(self.conf)
+
+    def tearDown(self):
+        lycheesyncer.LycheeDAO = self.LycheeDAO
+        shutil.rmtree(self.tmp)
+
+    def makePhotos(self, album, count):
+        return [makePhoto(os.path.join(self.conf["srcdir"], album, "photo%d.jpg" % i), (i * 60, 0, 0))
+                for i in range(count)]
+
+    def rows(self):
+        """
+        Returns the (album, title) of every photo in db
+        """
+        db = self.pool.connect()
+        try:
+            cur = db.cursor()
+            cur.execute("select album, title from lychee_photos order by title")
+            return [tuple(row) for row in cur.fetchall()]
+        finally:
+            db.close()
+
+    def bigFiles(self):
+        return os.listdir(os.path.join(self.conf["lycheepath"], "uploads", "big"))
+
+
+class SyncBatchTest(SyncerTestCase):
+
+    def testBatches(self):
+        self.makePhotos("album", 3)
+        self.assertEqual(self.syncer.syncBatch(2), 2)
+        self.assertEqual(len(self.rows()), 2)
+        self.assertEqual(self.syncer.syncBatch(5), 1)
+        self.assertEqual(self.syncer.syncBatch(5), 0)
+        self.assertEqual([title for album, title in self.rows()], ["photo0.jpg", "photo1.jpg", "photo2.jpg"])
+        self.assertEqual(len(self.bigFiles()), 3)
+
+    def testRootPhotosLeftOut(self):
+        makePhoto(os.path.join(self.conf["srcdir"], "root.jpg"))
+        self.makePhotos("album", 1)
+        self.assertEqual(self.syncer.syncBatch(5), 1)
+        self.assertEqual([title for album, title in self.rows()], ["photo0.jpg"])
+
+
+
+class ScanTest(SyncerTestCase):
+
+    def scan(self):
+        """
+        Run the startup scan alone
+        Returns the number of photos queued for import
+        """
+        self.syncer.openSync()
+        try:
+            return self.syncer.scan(self.syncer.dao.listPhotos())
+        finally:
+            self.syncer.closeSync()
+
+    def testUpToDate(self):
+        self.makePhotos("album", 2)
+        self.assertEqual(self.scan(), 2)
+        self.assertEqual(self.scan(), 0)
+        self.assertEqual(len(self.rows()), 2)
+
+    def testWithoutCatalog(self):
+        # photos imported before the catalog existed are recorded, not imported again
+        self.makePhotos("album", 2)
+        self.assertEqual(self.scan(), 2)
+        os.remove(self.conf["catalog"])
+        self.assertEqual(self.scan(), 0)
+        self.assertEqual(len(self.rows()), 2)
+        self.assertEqual(len(self.bigFiles()), 2)
+
+
+    def testDropdb(self):
+        self.makePhotos("album", 2)
+        self.assertEqual(self.scan(), 2)
+        self.conf["dropdb"] = True
+        self.assertEqual(self.scan(), 2)
+        self.assertEqual(len(self.rows()), 2)
+
+    def testDeletedInLychee(self):
+        # the catalog is not trusted for photos no longer in db
+        paths = self.makePhotos("album", 2)
+        self.assertEqual(self.scan(), 2)
+        db = self.pool.connect()
+        db.cursor().execute("delete from lychee_photos where title = %s", (os.path.basename(paths[0]),))
+        db.commit()
+        db.close()
+        self.assertEqual(self.scan(), 1)
+        self.assertEqual(len(self.rows()), 2)
+        self.assertEqual(self.scan(), 0)
+
+
+
+class WatchTest(SyncerTestCase):
+
+    """
+    Events of photos being imported or just imported, their inserts are still queued (see LycheeDAO.flush)
+    """
+
+    def setUp(self):
+        SyncerTestCase.setUp(self)
+        self.conf["dbBatchDelay"] = 60
+        self.conf["placement"] = "hardlink"
+        self.syncer.openSync()
+        self.handler = GalleryHandler(self.syncer)
+
+    def tearDown(self):
+        self.syncer.closeSync()
+        SyncerTestCase.tearDown(self)
+
+    def wait(self):
+        """
+        Wait for the imports in progress
+        """
+        while self.syncer.importer.pending:
+            time.sleep(0.01)
+
+    def testAttributesChanged(self):
+        # the hard link and the chmod of placeFile trigger a modified event on the source
+        path = self.makePhotos("album", 1)[0]
+        self.handler.importFile(path)
+        self.wait()
+        self.assertEqual(os.stat(path).st_nlink, 2)
+        self.handler.importFile(path)
+        self.wait()
+        self.syncer.dao.flush()
+        self.handler.importFile(path)
+        self.wait()
+        self.syncer.closeSync()
+        self.assertEqual(self.rows(), [("1", "photo0.jpg")])
+        self.assertEqual(len(self.bigFiles()), 1)
+        self.syncer.openSync()
+
+    def testModifiedWhileQueued(self):
+        path = self.makePhotos("album", 1)[0]
+        self.handler.importFile(path)
+        self.wait()
+        os.remove(path)
+        makePhoto(path, size=(128, 96))
+        self.handler.importFile(path)
+        self.wait()
+        self.syncer.closeSync()
+        self.assertEqual(self.rows(), [("1", "photo0.jpg")])
+        self.syncer.openSync()
+        self.assertTrue(self.syncer.isSynced(path))
+
+
+
+class DeleteTest(SyncerTestCase):
+
+    def testCatalogCommittedWithErasures(self):
+        paths = self.makePhotos("album", 3)
+        self.syncer.syncBatch(3)
+        self.conf["dbBatchDelay"] = 60
+        self.syncer.openSync()
+        try:
+            album = self.syncer.getAlbumFromPath(os.path.dirname(paths[0]))
+            for path in paths[:2]:
+                self.syncer.deletePhoto(dict(album), os.path.basename(path))
+            # forgotten in the transaction of the catalog, not committed yet
+            self.assertIsNone(self.syncer.catalog.lookup(paths[0]))
+            catalog = sqlite3.connect(self.conf["catalog"])
+            self.assertEqual(catalog.execute("select count(*) from photos").fetchone()[0], 3)
+            self.syncer.dao.flush()
+            self.assertEqual(catalog.execute("select count(*) from photos").fetchone()[0], 1)
+            catalog.close()
+        finally:
+            self.syncer.closeSync()
+        self.assertEqual([title for album, title in self.rows()], ["photo2.jpg"])
+
+
+if __name__ == '__main__':
+    unittest.main()
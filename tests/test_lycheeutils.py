@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import lycheeutils
+from lycheeutils import cloneFile, copyFileWithChecksum, copyRangeFile, fileChecksum, removeFiles
+
+
+class FilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "src.jpg")
+        self.dst = os.path.join(self.tmp, "dst.jpg")
+        # more than a chunk
+        self.data = os.urandom(lycheeutils.CHUNK_SIZE + 1000)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        self.copy_file_range = lycheeutils._copy_file_range
+
+    def tearDown(self):
+        lycheeutils._copy_file_range = self.copy_file_range
+        shutil.rmtree(self.tmp)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def testChecksum(self):
+        self.assertEqual(fileChecksum(self.src), hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(copyFileWithChecksum(self.src, self.dst), hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(self.read(self.dst), self.data)
+
+    def testShortCopyRange(self):
+        # the kernel copies nothing more: the copy is not left truncated
+        lycheeutils._copy_file_range = lambda *args: 0
+        try:
+            copyRangeFile(self.src, self.dst)
+            self.fail("short copy not detected")
+        except OSError as e:
+            self.assertEqual(e.errno, errno.EINVAL)
+        method, checksum = cloneFile(self.src, self.dst, ("copyrange", "copy"))
+        self.assertEqual(method, "copy")
+        self.assertEqual(self.read(self.dst), self.data)
+
+    def testHardlink(self):
+        method, checksum = cloneFile(self.src, self.dst, ("hardlink", "copy"))
+        self.assertEqual(method, "hardlink")
+        self.assertIsNone(checksum)
+        self.assertEqual(os.stat(self.dst).st_ino, os.stat(self.src).st_ino)
+
+    def testRemoveFiles(self):
+        self.assertEqual(removeFiles([self.src, self.dst]), 1)
+        self.assertFalse(os.path.exists(self.src))
+
+
+if __name__ == '__main__':
+    unittest.main()
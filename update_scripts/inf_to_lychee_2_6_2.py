@@ -2,20 +2,51 @@ import os
 import pwd
 import grp
 from lycheesyncer import LycheeSyncer
-import MySQLdb
-import hashlib
+from lycheeutils import fileChecksum
+from update_scripts.migration import Migration
 import stat
-import traceback
 
 
-# Compute checksum
-def __generateHash(filepath):
-    checksum = None
-    sha1 = hashlib.sha1()
-    with open(filepath, 'rb') as f:
-        sha1.update(f.read())
-        checksum = sha1.hexdigest()
-    return checksum
+class ChecksumMigration(Migration):
+
+    """
+    Lychee 2.6.2 requires the checksum of every photo: hash every big file again,
+    and fix the permissions of the photo files on the way
+    """
+
+    name = "2.6.2-checksums"
+    statement = "update lychee_photos set checksum = %s where id = %s"
+
+    def __init__(self, conf):
+        Migration.__init__(self, conf)
+        self.syncer = LycheeSyncer(conf)
+        self.upload_dir = os.path.join(conf["lycheepath"], "uploads")
+
+    def listItems(self, db):
+        cur = db.cursor()
+        cur.execute("select id, url from lychee_photos order by id")
+        return [tuple(row) for row in cur.fetchall()]
+
+    def fixPermissions(self, filepath):
+        """
+        Give a photo file to the owner of the lychee uploads directory
+        """
+        os.chown(filepath, int(self.conf["uid"]), int(self.conf["gid"]))
+        st = os.stat(filepath)
+        os.chmod(filepath, st.st_mode | stat.S_IRWXU | stat.S_IRWXG)
+
+    def work(self, item):
+        pid, url = item
+        photo_path = os.path.join(self.upload_dir, "big", url)
+        if not self.dryrun and self.syncer.isAPhoto(url):
+            # adjust permissions of the big file and thumbnails
+            self.fixPermissions(photo_path)
+            for thumb in self.syncer.thumbnailNames(url):
+                thumbpath = os.path.join(self.upload_dir, "thumb", thumb)
+                if os.path.exists(thumbpath):
+                    self.fixPermissions(thumbpath)
+        # for each photo in db recalculate checksum
+        return (fileChecksum(photo_path), pid)
 
 
 def updatedb(conf_data):
@@ -35,52 +66,7 @@ def updatedb(conf_data):
     conf_data["uid"] = uid
     conf_data["gid"] = gid
 
-    syncer = LycheeSyncer(conf_data)
-
-    # for each file in upload fix the permissions
-    for root, dirs, files in os.walk(upload_dir):
-        for f in files:
-            if syncer.isAPhoto(f):
-                # adjust permissions
-                filepath = os.path.join(root, f)
-                os.chown(filepath, int(uid), int(gid))
-                st = os.stat(filepath)
-                os.chmod(filepath, st.st_mode | stat.S_IRWXU | stat.S_IRWXG)
-                print "Changed permission for " + str(f)
-
-    # connect to db
-    try:
-        db = MySQLdb.connect(host=conf_data["dbHost"],
-                             user=conf_data["dbUser"],
-                             passwd=conf_data["dbPassword"],
-                             db=conf_data["db"])
-
-        # get photo list
-        cur = db.cursor()
-        cur.execute("SELECT id, url from lychee_photos")
-        rows = cur.fetchall()
-        for row in rows:
-
-            pid = row[0]
-            url = row[1]
-
-            photo_path = os.path.join(upload_dir, "big", url)
-            chksum = __generateHash(photo_path)
-            # for each photo in db recalculate checksum
-            qry = "update lychee_photos set checksum= '" + chksum + "' where id=" + str(pid)
-            try:
-                cur = db.cursor()
-                cur.execute(qry)
-                db.commit()
-                print "INFO photo checksum changed to: ", chksum
-            except Exception:
-                print "checksum modification failed for photo:" + id, Exception
-                traceback.print_exc()
-
+    if ChecksumMigration(conf_data).run(conf_data.get("dryrun", False)):
         print "******************************"
         print "SUCCESS"
         print "******************************"
-    except Exception:
-        traceback.print_exc()
-    finally:
-        db.close()
@@ -0,0 +1,212 @@
+import multiprocessing
+import signal
+import time
+import traceback
+from lycheedao import ConnectionPool
+
+
+# Migration of the current worker process (see initMigrationWorker)
+worker_migration = None
+
+
+def initMigrationWorker(migration):
+    """
+    Initialize a migration worker process
+    Ctrl+C is left to the main process which will stop the pool
+    """
+    global worker_migration
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_migration = migration
+
+
+def runWork(item):
+    """
+    Run the work of a migration on an item, in a worker process
+    Returns (item key, result), result is None on error
+    """
+    try:
+        return item[0], worker_migration.work(item)
+    except Exception:
+        print "migration", worker_migration.name, "failed for:", item[0]
+        traceback.print_exc()
+        return item[0], None
+
+
+class Migration:
+
+    """
+    Base of the lychee db migrations
+    A migration lists items (usually photos) from db, computes something for each of them
+    in parallel worker processes (conf "workers") and writes the results by batches of batchSize rows.
+    Its progress is stored in db, along with each batch, in the lycheesync_migrations table:
+    an interrupted migration (crash, Ctrl+C) resumes after its last written batch.
+    Subclasses define name, statement and:
+    - listItems(db): returns the list of (key, ...) tuples to migrate, sorted by increasing numeric key
+    - work(item): the CPU or io bound part of the migration of an item, runs in a worker process
+      without db access. Returns the statement parameters for this item, raises on error
+    """
+
+    # unique migration name, the checkpoint key
+    name = ""
+    # update statement, run with executemany on the work results
+    statement = ""
+    batchSize = 500
+    # items timed to estimate a dry run
+    sampleSize = 20
+
+    def __init__(self, conf):
+        """
+        Takes a dictionnary of conf as input
+        """
+        self.conf = conf
+        # set during a dry run: work must not change anything
+        self.dryrun = False
+        self.workers = self.conf.get("workers")
+        if self.workers is None:
+            self.workers = multiprocessing.cpu_count()
+
+    def loadCheckpoint(self, db):
+        """
+        Returns the (last key written, done flag) of this migration
+        A dry run does not create the checkpoint table
+        """
+        cur = db.cursor()
+        if self.dryrun:
+            cur.execute("show tables like 'lycheesync_migrations'")
+            if cur.fetchone() is None:
+                return None, False
+        else:
+            cur.execute("create table if not exists lycheesync_migrations (" +
+                        "name varchar(100) not null primary key, lastkey bigint, done integer not null default 0)")
+            db.commit()
+        cur.execute("select lastkey, done from lycheesync_migrations where name = %s", (self.name,))
+        row = cur.fetchone()
+        if row is None:
+            return None, False
+        return row[0], bool(row[1])
+
+    def saveCheckpoint(self, cur, lastkey, done=False):
+        """
+        Record the migration progress, in the transaction of the last batch
+        """
+        cur.execute("delete from lycheesync_migrations where name = %s", (self.name,))
+        cur.execute("insert into lycheesync_migrations (name, lastkey, done) values (%s, %s, %s)",
+                    (self.name, lastkey, int(done)))
+
+    def writeBatch(self, dbpool, results, lastkey, done=False):
+        """
+        Write a batch of results and the checkpoint in a single transaction
+        """
+        with dbpool.connection() as db:
+            cur = db.cursor()
+            if results:
+                cur.executemany(self.statement, results)
+            self.saveCheckpoint(cur, lastkey, done)
+            db.commit()
+
+    def estimate(self, items):
+        """
+        Dry run: time the work on a sample of items, nothing is written
+        Returns the estimated duration in seconds
+        """
+        sample = items[:self.sampleSize]
+        start = time.time()
+        for item in sample:
+            self.work(item)
+        elapsed = time.time() - start
+        if not sample:
+            return 0
+        estimate = elapsed / len(sample) * len(items) / max(self.workers, 1)
+        print "INFO migration %s dry run: %d items to migrate, %.3fs per item, about %ds with %d workers" % (
+            self.name, len(items), elapsed / len(sample), estimate, max(self.workers, 1))
+        return estimate
+
+    def report(self, done, failed, total, started):
+        elapsed = max(time.time() - started, 0.001)
+        speed = (done + failed) / elapsed
+        eta = (total - done - failed) / speed if speed else 0
+        print "INFO migration %s: %d/%d done, %d failed, %.1f items/s, %ds left" % (
+            self.name, done, total, failed, speed, eta)
+
+    def run(self, dryrun=False):
+        """
+        Migrate every item not migrated yet
+        Parameters:
+        - dryrun: only report what would be done and how long it would take
+        Returns True if the migration is complete, items that failed are retried by the next run
+        """
+        self.dryrun = dryrun
+        dbpool = ConnectionPool(self.conf, 1)
+        with dbpool.connection() as db:
+            lastkey, complete = self.loadCheckpoint(db)
+            items = self.listItems(db)
+        # worker processes are forked without an open db connection
+        dbpool.close()
+        if complete:
+            print "INFO migration", self.name, "already applied"
+            return True
+        if lastkey is not None:
+            items = [item for item in items if long(item[0]) > long(lastkey)]
+            print "INFO migration", self.name, "resuming after", lastkey
+        if dryrun:
+            self.estimate(items)
+            return False
+
+        pool = None
+        if self.workers > 0:
+            pool = multiprocessing.Pool(self.workers, initMigrationWorker, (self,))
+            results = pool.imap(runWork, items)
+        else:
+            initMigrationWorker(self)
+            results = (runWork(item) for item in items)
+
+        done = failed = 0
+        batch = []
+        # the checkpoint stays before the first failed item, so that the next run retries it
+        started = lastreport = time.time()
+        complete = False
+        try:
+            for i in xrange(len(items)):
+                if pool:
+                    # with a timeout, so that Ctrl+C is not blocked while waiting
+                    while True:
+                        try:
+                            key, result = results.next(1)
+                            break
+                        except multiprocessing.TimeoutError:
+                            pass
+                else:
+                    key, result = results.next()
+                if result is None:
+                    failed += 1
+                else:
+                    done += 1
+                    batch.append(result)
+                    if not failed:
+                        lastkey = key
+                if len(batch) >= self.batchSize:
+                    self.writeBatch(dbpool, batch, lastkey)
+                    batch = []
+                if time.time() - lastreport > 5:
+                    lastreport = time.time()
+                    self.report(done, failed, len(items), started)
+            self.writeBatch(dbpool, batch, lastkey, done=not failed)
+            batch = []
+            complete = True
+        except KeyboardInterrupt:
+            print "INFO migration", self.name, "cancelled, run it again to resume"
+            if batch:
+                self.writeBatch(dbpool, batch, lastkey)
+        finally:
+            if pool:
+                if complete:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+            dbpool.close()
+
+        self.report(done, failed, len(items), started)
+        if failed:
+            print "INFO migration", self.name, "incomplete:", failed, "items failed, run it again to retry them"
+        return complete and not failed